@@ -0,0 +1,103 @@
+"""
+Compare the embedding backends on the documents of the current vectorstore.
+
+Reports query latency, document throughput and recall@k of every backend, using the
+full precision torch backend as reference for recall.
+
+Usage:
+    python -m benchmarks.embedding_backends --backends torch int8 onnx onnx-int8 --documents 500
+"""
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+from src.setup import load_embedding_function, open_vectorstore, get_current_store_directory, VECTORSTORE_VALIDATION_QUERIES
+from src.models.context_router import EXAMPLE_QUERIES
+import numpy as np
+import argparse
+import time
+
+
+def load_documents(limit):
+    # Only the stored texts are needed, embeddings are recomputed by every backend
+    db = open_vectorstore(None, get_current_store_directory())
+    return db.get(limit=limit, include=["documents"])["documents"]
+
+
+def load_queries():
+    queries = list(VECTORSTORE_VALIDATION_QUERIES)
+    for examples in EXAMPLE_QUERIES.values():
+        queries.extend(examples)
+    return queries
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+
+
+def run_backend(backend, documents, queries):
+    start = time.perf_counter()
+    embedding = load_embedding_function(backend, cache=False, batching=False)
+    load_time = time.perf_counter() - start
+
+    # Warm up, the first call includes lazy initialization
+    embedding.embed_query(queries[0])
+
+    latencies = []
+    query_vectors = []
+    for query in queries:
+        start = time.perf_counter()
+        query_vectors.append(embedding.embed_query(query))
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    document_vectors = embedding.embed_documents(documents)
+    indexing_time = time.perf_counter() - start
+
+    return {
+        "load_time": load_time,
+        "latencies": np.asarray(latencies),
+        "throughput": len(documents) / indexing_time,
+        "query_vectors": normalize(query_vectors),
+        "document_vectors": normalize(document_vectors),
+    }
+
+
+def top_k(result, k):
+    scores = result["query_vectors"] @ result["document_vectors"].T
+    return np.argsort(-scores, axis=1)[:, :k]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backends", nargs="+", default=["torch", "int8", "onnx", "onnx-int8"])
+    parser.add_argument("--documents", type=int, default=500, help="Number of stored documents to embed")
+    parser.add_argument("--k", type=int, default=5, help="Number of results compared for recall")
+    args = parser.parse_args()
+
+    documents = load_documents(args.documents)
+    queries = load_queries()
+    print(f"Benchmarking on {len(documents)} documents and {len(queries)} queries")
+
+    backends = args.backends if "torch" in args.backends else ["torch"] + args.backends
+    results = {backend: run_backend(backend, documents, queries) for backend in backends}
+    reference = top_k(results["torch"], args.k)
+
+    print(f"{'backend':<12}{'load s':>10}{'p50 ms':>10}{'p95 ms':>10}{'docs/sec':>12}{f'recall@{args.k}':>12}")
+    for backend, result in results.items():
+        retrieved = top_k(result, args.k)
+        recall = np.mean(
+            [len(set(a) & set(b)) / args.k for a, b in zip(retrieved, reference)]
+        )
+        latencies = result["latencies"] * 1000
+        print(
+            f"{backend:<12}{result['load_time']:>10.1f}"
+            f"{np.percentile(latencies, 50):>10.1f}{np.percentile(latencies, 95):>10.1f}"
+            f"{result['throughput']:>12.1f}{recall:>12.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
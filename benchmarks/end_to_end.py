@@ -0,0 +1,358 @@
+"""
+End to end benchmark of crawling, indexing, retrieval and the chat endpoint.
+
+Runs against a local synthetic Moodle site and a stub LLM server, so neither a Moodle
+instance nor an LLM is needed. All data is written to a temporary working directory.
+
+Reports crawl time, indexing throughput, query embedding latency, retrieval latency and
+the p50/p95/p99 latency of /chat (or time to first event of /chat/stream) under concurrent
+load. The query embedding and answer caches are disabled unless requested, so repeated
+benchmark queries measure the full pipeline.
+
+Crawling and indexing run interleaved as in production, the crawl time is the time spent
+waiting for the crawler and the indexing time the rest.
+
+Usage:
+    python -m benchmarks.end_to_end --courses 20 --requests 200 --concurrency 16 --llm-latency 0.3
+"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.fake_moodle import SyntheticSite, start_fake_moodle
+from benchmarks.fake_llm import start_fake_llm
+import numpy as np
+import tempfile
+import threading
+import argparse
+import asyncio
+import random
+import shutil
+import socket
+import json
+import time
+
+QUERIES = [
+    "Welche Kurse gibt es zum Thema {topic}?",
+    "Gibt es Kurse zu {topic} und {other}?",
+    "Kannst du mir einen Kurs über {topic} empfehlen?",
+    "Worum geht es in diesem Kurs über {topic}?",
+    "Welche Materialien zu {topic} gibt es in diesem Kurs?",
+    "Wo finde ich die Aufgabe zu {topic} in diesem Kurs?",
+]
+TOPICS = [
+    "Programmierung", "Statistik", "Datenbank", "Sicherheit", "Robotik", "Ethik",
+    "Visualisierung", "Optimierung", "Bildverarbeitung", "Kommunikation", "Mathematik", "Cloud",
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    site = parser.add_argument_group("synthetic site")
+    site.add_argument("--courses", type=int, default=20)
+    site.add_argument("--sections", type=int, default=6, help="Sections per course")
+    site.add_argument("--modules", type=int, default=5, help="Modules per section")
+    site.add_argument("--files", type=int, default=1, help="HTML files per module")
+    site.add_argument("--paragraphs", type=int, default=6, help="Paragraphs of 80 words per file")
+    site.add_argument("--moodle-latency", type=float, default=0.0, help="Seconds added to every Moodle response")
+    llm = parser.add_argument_group("stub LLM")
+    llm.add_argument("--llm-latency", type=float, default=0.3, help="Seconds until the first token")
+    llm.add_argument("--tokens-per-second", type=float, default=50.0)
+    llm.add_argument("--answer-tokens", type=int, default=64)
+    load = parser.add_argument_group("load")
+    load.add_argument("--queries", type=int, default=50, help="Queries for the embedding and retrieval latency")
+    load.add_argument("--requests", type=int, default=200, help="Chat requests sent under load, 0 skips the load test")
+    load.add_argument("--concurrency", type=int, default=16, help="Chat requests in flight")
+    load.add_argument("--stream", action="store_true", help="Load /chat/stream and report the time to the first event")
+    load.add_argument("--query-cache", action="store_true", help="Keep the query embedding cache enabled")
+    load.add_argument("--answer-cache", action="store_true", help="Keep the semantic answer cache enabled")
+    parser.add_argument("--workdir", help="Working directory for stores and caches, a temporary one by default")
+    parser.add_argument("--output", help="Write the results as json to this file")
+    return parser.parse_args()
+
+
+def configure_environment(args, moodle_url, llm_url):
+    # Settings are read when the modules are imported, so they are set before importing src
+    os.environ.update(
+        {
+            "MOODLE_URL": moodle_url,
+            "MOODLE_API_TOKEN": "benchmark",
+            "MOODLE_CRAWL_RATE_LIMIT": "0",
+            "DEFAULT_CUSTOM_LLM_URL": llm_url,
+            "MINI_CUSTOM_LLM_URL": llm_url,
+        }
+    )
+    if not args.query_cache:
+        os.environ["QUERY_EMBEDDING_CACHE_SIZE"] = "0"
+    if not args.answer_cache:
+        os.environ["ANSWER_CACHE_SIZE"] = "0"
+
+
+def make_queries(count, course_ids, seed=0):
+    rng = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        topic, other = rng.sample(TOPICS, 2)
+        queries.append(
+            {
+                "message": rng.choice(QUERIES).format(topic=topic, other=other),
+                "course_id": str(rng.choice(course_ids)),
+                "usercontext": "Dashboard",
+            }
+        )
+    return queries
+
+
+def summarize(seconds):
+    milliseconds = np.asarray(seconds) * 1000
+    if not len(milliseconds):
+        return {}
+    return {
+        "count": int(len(milliseconds)),
+        "mean_ms": float(milliseconds.mean()),
+        "p50_ms": float(np.percentile(milliseconds, 50)),
+        "p95_ms": float(np.percentile(milliseconds, 95)),
+        "p99_ms": float(np.percentile(milliseconds, 99)),
+    }
+
+
+def timed_objects(objects, crawl):
+    # Counts the objects and the time spent waiting for the crawler while they pass through
+    iterator = iter(objects)
+    while True:
+        start = time.perf_counter()
+        try:
+            obj = next(iterator)
+        except StopIteration:
+            crawl["seconds"] += time.perf_counter() - start
+            return
+        crawl["seconds"] += time.perf_counter() - start
+        crawl["objects"] += 1
+        yield obj
+
+
+def benchmark_crawl_and_indexing():
+    from src.scrape_moodle import stream_moodle_data
+    from src.setup import load_embedding_function, open_store_client, open_vectorstore, sync_vectorstore, iter_documents
+
+    start = time.perf_counter()
+    embedding = load_embedding_function()
+    load_time = time.perf_counter() - start
+
+    persist_directory, client, _ = open_store_client()
+    db = open_vectorstore(embedding, persist_directory, client)
+    # Documents are built while the crawler streams, like in production: a course's sections
+    # are released once its objects are yielded and the course document is built from them
+    crawl = {"objects": 0, "seconds": 0.0}
+    start = time.perf_counter()
+    sync_vectorstore(db, iter_documents(timed_objects(stream_moodle_data(incremental=False), crawl)))
+    elapsed = time.perf_counter() - start - crawl["seconds"]
+    crawl["objects_per_sec"] = crawl["objects"] / crawl["seconds"]
+    count = db._collection.count()
+    return embedding, db, crawl, {
+        "model_load_seconds": load_time,
+        "documents": count,
+        "seconds": elapsed,
+        "docs_per_sec": count / elapsed,
+    }
+
+
+def benchmark_queries(embedding, db, queries):
+    from src.routes.main_router import retrieve_context
+
+    # Warm up, the first call includes lazy initialization
+    embedding.embed_query(queries[0]["message"])
+
+    embedding_latencies = []
+    query_embeddings = []
+    for query in queries:
+        start = time.perf_counter()
+        query_embeddings.append(embedding.embed_query(query["message"]))
+        embedding_latencies.append(time.perf_counter() - start)
+
+    retrieval = {}
+    for predicted_context in ("Site-Context", "Course-Context", None):
+        latencies, errors = [], 0
+        for query, query_embedding in zip(queries, query_embeddings):
+            start = time.perf_counter()
+            try:
+                retrieve_context(db, query["message"], query_embedding, predicted_context, query["course_id"])
+            except Exception as e:
+                # A failing context is reported with the results instead of aborting the benchmark
+                errors += 1
+                print(f"Retrieval for {predicted_context} failed: {e!r}")
+                continue
+            latencies.append(time.perf_counter() - start)
+        retrieval[str(predicted_context)] = {**summarize(latencies), "errors": errors}
+
+    return {"query_embedding": summarize(embedding_latencies), "retrieval": retrieval}
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app():
+    import uvicorn
+    from src.app import app
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    return server, f"http://127.0.0.1:{port}"
+
+
+async def wait_until_ready(client, url, timeout=600):
+    import httpx
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            response = await client.get(f"{url}/health/ready")
+        except httpx.TransportError:
+            # The server is still starting
+            response = None
+        if response is not None:
+            if response.status_code == 200:
+                return
+            if response.json().get("status") == "failed":
+                raise RuntimeError("Loading resources failed: " + str(response.json().get("error")))
+        await asyncio.sleep(0.5)
+    raise TimeoutError("The app did not become ready")
+
+
+async def run_load(url, queries, concurrency, stream):
+    import httpx
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, first_event_latencies, errors = [], [], 0
+
+    async def send(client, query):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                if stream:
+                    async with client.stream("POST", f"{url}/chat/stream", json=query) as response:
+                        response.raise_for_status()
+                        first_event = None
+                        async for _ in response.aiter_lines():
+                            if first_event is None:
+                                first_event = time.perf_counter() - start
+                        first_event_latencies.append(first_event)
+                else:
+                    response = await client.post(f"{url}/chat", json=query)
+                    response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors += 1
+                print(f"Request failed: {e!r}")
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=300) as client:
+        await wait_until_ready(client, url)
+        # Warm up the connections and lazily initialized clients
+        await asyncio.gather(*(send(client, query) for query in queries[:concurrency]))
+        latencies.clear()
+        first_event_latencies.clear()
+        errors = 0
+
+        start = time.perf_counter()
+        await asyncio.gather(*(send(client, query) for query in queries))
+        elapsed = time.perf_counter() - start
+
+    result = {
+        "endpoint": "/chat/stream" if stream else "/chat",
+        "concurrency": concurrency,
+        "errors": errors,
+        "requests_per_sec": len(latencies) / elapsed,
+        "latency": summarize(latencies),
+    }
+    if stream:
+        result["first_event"] = summarize(first_event_latencies)
+    return result
+
+
+def print_latency(name, summary):
+    if summary and summary.get("count"):
+        print(
+            f"  {name:<28}p50 {summary['p50_ms']:>8.1f} ms  p95 {summary['p95_ms']:>8.1f} ms  "
+            f"p99 {summary['p99_ms']:>8.1f} ms  (n={summary['count']})"
+            + (f"  {summary['errors']} errors" if summary.get("errors") else "")
+        )
+    elif summary and summary.get("errors"):
+        print(f"  {name:<28}all {summary['errors']} requests failed")
+
+
+def print_report(results):
+    crawl, indexing, queries = results["crawl"], results["indexing"], results["queries"]
+    print()
+    print(f"Crawl:     {crawl['objects']} objects in {crawl['seconds']:.2f} s ({crawl['objects_per_sec']:.1f} objects/sec)")
+    print(
+        f"Indexing:  {indexing['documents']} documents in {indexing['seconds']:.2f} s "
+        f"({indexing['docs_per_sec']:.1f} docs/sec), model loaded in {indexing['model_load_seconds']:.1f} s"
+    )
+    print("Queries:")
+    print_latency("embedding", queries["query_embedding"])
+    for context, summary in queries["retrieval"].items():
+        print_latency(f"retrieval {context}", summary)
+    chat = results.get("chat")
+    if chat:
+        print(
+            f"Chat:      {chat['endpoint']} at concurrency {chat['concurrency']}, "
+            f"{chat['requests_per_sec']:.1f} requests/sec, {chat['errors']} errors"
+        )
+        print_latency("latency", chat["latency"])
+        print_latency("first event", chat.get("first_event"))
+
+
+def main():
+    args = parse_args()
+    site = SyntheticSite(args.courses, args.sections, args.modules, args.files, args.paragraphs)
+    moodle_server, moodle_url = start_fake_moodle(site, latency=args.moodle_latency)
+    llm_server, llm_url = start_fake_llm(
+        latency=args.llm_latency, tokens_per_second=args.tokens_per_second, answer_tokens=args.answer_tokens
+    )
+    configure_environment(args, moodle_url, llm_url)
+    output = os.path.abspath(args.output) if args.output else None
+
+    # Stores, manifests and caches are created relative to the working directory
+    workdir = args.workdir or tempfile.mkdtemp(prefix="moodle-rag-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+    print(f"Benchmarking a synthetic site with {site.object_count()} objects in {workdir}")
+
+    try:
+        results = {"site": vars(site)}
+        embedding, db, results["crawl"], results["indexing"] = benchmark_crawl_and_indexing()
+
+        course_ids = [course["id"] for course in site.get_courses()[1:]]
+        results["queries"] = benchmark_queries(embedding, db, make_queries(args.queries, course_ids))
+
+        if args.requests > 0:
+            # The app loads its own embedding model and opens the store built above
+            del embedding, db
+            server, url = start_app()
+            queries = make_queries(args.requests, course_ids, seed=1)
+            results["chat"] = asyncio.run(run_load(url, queries, args.concurrency, args.stream))
+            server.should_exit = True
+
+        print_report(results)
+        if output:
+            with open(output, "w") as f:
+                json.dump(results, f, indent=2)
+    finally:
+        moodle_server.shutdown()
+        llm_server.shutdown()
+        os.chdir(ROOT)
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
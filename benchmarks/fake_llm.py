@@ -0,0 +1,129 @@
+"""
+A stub OpenAI compatible chat completions server with configurable latency.
+
+Answers every request after `--latency` seconds with a fixed text generated at
+`--tokens-per-second`, streamed as server sent events when the request asks for a stream.
+Context prediction prompts are answered with a context label, so the router can parse them.
+
+Usage:
+    python -m benchmarks.fake_llm --latency 0.3 --tokens-per-second 50 --port 8082
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import argparse
+import json
+import time
+
+ANSWER = (
+    "Auf der Plattform gibt es mehrere passende Kurse. Der Kurs behandelt die Grundlagen, "
+    "enthält Übungen zu jedem Kapitel und schließt mit einem Projekt ab."
+)
+
+
+def create_handler(latency: float, tokens_per_second: float, answer_tokens: int):
+    class FakeLLMHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                return self.send_json({"error": {"message": "not found"}}, 404)
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            prompt = " ".join(str(message.get("content", "")) for message in body.get("messages", []))
+
+            if "[Course-Context]" in prompt:
+                # Context prediction, questions about "this course" are routed to the course
+                query = prompt.split("User Query:", 1)[-1].split("User Context:", 1)[0].lower()
+                tokens = ["[Course-Context]" if "diese" in query or "this course" in query else "[Site-Context]"]
+            else:
+                words = ANSWER.split()
+                count = min(answer_tokens, body.get("max_tokens") or answer_tokens)
+                tokens = [words[i % len(words)] + " " for i in range(count)]
+
+            # Latency until the first token, then the tokens at the configured rate
+            time.sleep(latency)
+            delay = 1.0 / tokens_per_second if tokens_per_second > 0 else 0.0
+            if body.get("stream"):
+                self.stream(body, tokens, delay)
+            else:
+                time.sleep(delay * len(tokens))
+                self.send_json(self.completion(body, "".join(tokens).strip(), len(tokens)))
+
+        def completion(self, body, content, completion_tokens):
+            return {
+                "id": "chatcmpl-benchmark",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "-"),
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+                ],
+                "usage": {"prompt_tokens": 0, "completion_tokens": completion_tokens, "total_tokens": completion_tokens},
+            }
+
+        def stream(self, body, tokens, delay):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for index, token in enumerate(tokens + [None]):
+                if index:
+                    time.sleep(delay)
+                delta = {"content": token} if token is not None else {}
+                chunk = {
+                    "id": "chatcmpl-benchmark",
+                    "object": "chat.completion.chunk",
+                    "created": int(time.time()),
+                    "model": body.get("model", "-"),
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": None if token is not None else "stop"}],
+                }
+                self.write_chunk(f"data: {json.dumps(chunk)}\n\n")
+            self.write_chunk("data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+
+        def write_chunk(self, text):
+            data = text.encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def send_json(self, data, status=200):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeLLMHandler
+
+
+def start_fake_llm(host="127.0.0.1", port=0, latency=0.3, tokens_per_second=50.0, answer_tokens=64):
+    """Serve the stub in a background thread and return the server and its openai api base url."""
+    server = ThreadingHTTPServer((host, port), create_handler(latency, tokens_per_second, answer_tokens))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.3, help="Seconds until the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="Generation rate, 0 sends all tokens at once")
+    parser.add_argument("--answer-tokens", type=int, default=64, help="Tokens per answer")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8082)
+    args = parser.parse_args()
+
+    server, url = start_fake_llm(args.host, args.port, args.latency, args.tokens_per_second, args.answer_tokens)
+    print(f"Serving a stub LLM at {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+"""
+A local stand-in for the Moodle REST API serving a synthetic site.
+
+Implements the web service functions used by the crawler (core_course_get_courses and
+core_course_get_contents) and the file downloads of module contents. The site is generated
+deterministically from a seed, so runs with the same size are comparable.
+
+Usage:
+    python -m benchmarks.fake_moodle --courses 50 --sections 8 --modules 6 --files 2 --port 8081
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import threading
+import argparse
+import random
+import json
+import time
+
+WORDS = (
+    "Einführung Grundlagen Programmierung Daten Analyse Statistik Lernen Modell Netzwerk Projekt "
+    "Übung Aufgabe Vorlesung Seminar Kapitel Beispiel Methode Algorithmus Theorie Praxis Python "
+    "Datenbank Sicherheit Cloud Design Forschung Ethik Management Kommunikation Mathematik "
+    "Visualisierung Optimierung Simulation Robotik Sprache Bildverarbeitung Feedback Quiz Wiki Forum"
+).split()
+MODNAMES = ("page", "resource", "url", "quiz", "forum", "assign", "book")
+
+
+class SyntheticSite:
+    """A Moodle site with `courses` courses of `sections` sections with `modules` modules each."""
+
+    def __init__(self, courses=20, sections=6, modules=5, files=1, paragraphs=6, seed=42):
+        self.courses = courses
+        self.sections = sections
+        self.modules = modules
+        self.files = files
+        self.paragraphs = paragraphs
+        self.seed = seed
+        self.timemodified = 1700000000
+
+    def _random(self, *key):
+        # String seeds are hashed deterministically, unlike tuples of strings
+        return random.Random("-".join(map(str, (self.seed,) + key)))
+
+    def _words(self, rng, count):
+        return " ".join(rng.choice(WORDS) for _ in range(count))
+
+    def get_courses(self):
+        site = {"id": 1, "fullname": "FutureLearnLab Benchmark", "summary": "<p>Synthetische Kursplattform</p>"}
+        courses = []
+        for course_id in range(2, self.courses + 2):
+            rng = self._random("course", course_id)
+            courses.append(
+                {
+                    "id": course_id,
+                    "fullname": f"Kurs {course_id}: {self._words(rng, 3)}",
+                    "summary": f"<p>{self._words(rng, 40)}</p>",
+                    "timemodified": self.timemodified,
+                }
+            )
+        return [site] + courses
+
+    def get_contents(self, base_url, course_id):
+        sections = []
+        for section_index in range(self.sections):
+            section_id = course_id * 1000 + section_index
+            rng = self._random("section", section_id)
+            modules = []
+            for module_index in range(self.modules):
+                module_id = section_id * 100 + module_index
+                contents = [
+                    {
+                        "type": "file",
+                        "filename": f"page{file_index}.html",
+                        "fileurl": f"{base_url}/webservice/pluginfile.php/{module_id}/page{file_index}.html",
+                        "timemodified": self.timemodified,
+                        "mimetype": "text/html",
+                    }
+                    for file_index in range(self.files)
+                ]
+                modules.append(
+                    {
+                        "id": module_id,
+                        "name": self._words(rng, 4),
+                        "modname": rng.choice(MODNAMES),
+                        "url": f"{base_url}/mod/page/view.php?id={module_id}",
+                        "contents": contents,
+                    }
+                )
+            sections.append(
+                {
+                    "id": section_id,
+                    "name": f"Abschnitt {section_index + 1}: {self._words(rng, 3)}",
+                    "summary": f"<p>{self._words(rng, 25)}</p>",
+                    "modules": modules,
+                }
+            )
+        return sections
+
+    def get_file(self, module_id, filename):
+        rng = self._random("file", module_id, filename)
+        paragraphs = "".join(f"<p>{self._words(rng, 80)}</p>" for _ in range(self.paragraphs))
+        return f"<html><head><style>p {{}}</style></head><body><h1>{self._words(rng, 4)}</h1>{paragraphs}</body></html>"
+
+    def object_count(self):
+        files = self.courses * self.sections * self.modules * self.files
+        return 1 + self.courses * (1 + self.sections + self.sections * self.modules) + files
+
+
+def create_handler(site: SyntheticSite, latency: float):
+    class FakeMoodleHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if latency:
+                time.sleep(latency)
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            base_url = f"http://{self.headers['Host']}"
+
+            if url.path == "/webservice/rest/server.php":
+                function = params.get("wsfunction")
+                if function == "core_course_get_courses":
+                    return self.send_json(site.get_courses())
+                if function == "core_course_get_contents":
+                    return self.send_json(site.get_contents(base_url, int(params["courseid"])))
+                return self.send_json({"exception": "webservice_access_exception", "errorcode": function}, 404)
+
+            if url.path.startswith("/webservice/pluginfile.php/"):
+                _, module_id, filename = url.path.rsplit("/", 2)
+                return self.send_body(site.get_file(int(module_id), filename).encode("utf-8"), "text/html; charset=utf-8")
+
+            self.send_json({"error": "not found"}, 404)
+
+        def send_json(self, data, status=200):
+            self.send_body(json.dumps(data).encode("utf-8"), "application/json", status)
+
+        def send_body(self, body, content_type, status=200):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeMoodleHandler
+
+
+def start_fake_moodle(site: SyntheticSite, host="127.0.0.1", port=0, latency=0.0):
+    """Serve the site in a background thread and return the server and its base url."""
+    server = ThreadingHTTPServer((host, port), create_handler(site, latency))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--courses", type=int, default=20)
+    parser.add_argument("--sections", type=int, default=6, help="Sections per course")
+    parser.add_argument("--modules", type=int, default=5, help="Modules per section")
+    parser.add_argument("--files", type=int, default=1, help="HTML files per module")
+    parser.add_argument("--paragraphs", type=int, default=6, help="Paragraphs of 80 words per file")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds added to every response")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+
+    site = SyntheticSite(args.courses, args.sections, args.modules, args.files, args.paragraphs)
+    server, url = start_fake_moodle(site, args.host, args.port, args.latency)
+    print(f"Serving a synthetic Moodle site with {site.object_count()} objects at {url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
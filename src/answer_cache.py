@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from typing import List, Optional
+import numpy as np
+import threading
+import time
+import os
+
+# Semantic answer cache settings, a size of 0 disables the cache
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+# Minimum cosine similarity between two queries to reuse an answer
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.95"))
+# Seconds a cached answer stays valid, 0 keeps answers until the vectorstore is refreshed
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "0"))
+
+
+class CachedAnswer:
+    def __init__(self, query: str, answer: str, predicted_context: Optional[str]):
+        self.query = query
+        self.answer = answer
+        self.predicted_context = predicted_context
+        self.created = time.time()
+
+
+class SemanticAnswerCache:
+    """
+    Reuses answers for queries that are semantically close to a previously answered query.
+
+    Answers are grouped by course_id and usercontext and matched by cosine similarity of the
+    query embeddings. The predicted context is a function of the query and the user context,
+    so it is stored with the answer and a cache hit also skips the context prediction.
+    Every call to `clear` starts a new generation, answers computed against an older
+    vectorstore are discarded instead of being stored.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = ANSWER_CACHE_SIZE,
+        threshold: float = ANSWER_CACHE_THRESHOLD,
+        ttl: float = ANSWER_CACHE_TTL,
+    ):
+        self.maxsize = maxsize
+        self.threshold = threshold
+        self.ttl = ttl
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        # (course_id, usercontext) -> OrderedDict of entry id -> (normalized embedding, CachedAnswer)
+        self._buckets = {}
+        # Entry ids in least recently used order, for eviction across buckets
+        self._lru = OrderedDict()
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.maxsize > 0
+
+    def get(
+        self, embedding: List[float], course_id: Optional[str], usercontext: Optional[str]
+    ) -> Optional[CachedAnswer]:
+        if not self.enabled:
+            return None
+        vector = _normalize(embedding)
+        bucket_key = (course_id, usercontext)
+        with self._lock:
+            bucket = self._buckets.get(bucket_key)
+            best_id, best_score = None, self.threshold
+            if bucket:
+                for entry_id, (entry_vector, entry) in list(bucket.items()):
+                    if self.ttl > 0 and time.time() - entry.created > self.ttl:
+                        self._remove(bucket_key, entry_id)
+                        continue
+                    score = float(np.dot(vector, entry_vector))
+                    if score >= best_score:
+                        best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._lru.move_to_end(best_id)
+            return bucket[best_id][1]
+
+    def put(
+        self,
+        embedding: List[float],
+        course_id: Optional[str],
+        usercontext: Optional[str],
+        answer: CachedAnswer,
+        generation: int,
+    ):
+        if not self.enabled:
+            return
+        bucket_key = (course_id, usercontext)
+        with self._lock:
+            if generation != self.generation:
+                return
+            entry_id = self._next_id
+            self._next_id += 1
+            self._buckets.setdefault(bucket_key, OrderedDict())[entry_id] = (
+                _normalize(embedding),
+                answer,
+            )
+            self._lru[entry_id] = bucket_key
+            while len(self._lru) > self.maxsize:
+                oldest_id, oldest_bucket = next(iter(self._lru.items()))
+                self._remove(oldest_bucket, oldest_id)
+
+    def _remove(self, bucket_key, entry_id):
+        bucket = self._buckets.get(bucket_key)
+        if bucket is not None:
+            bucket.pop(entry_id, None)
+            if not bucket:
+                del self._buckets[bucket_key]
+        self._lru.pop(entry_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            self._lru.clear()
+            self.generation += 1
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._lru),
+            "maxsize": self.maxsize,
+            "generation": self.generation,
+        }
+
+
+def _normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
@@ -1,28 +1,111 @@
+from dotenv import load_dotenv
+
+# Load the environment before importing modules that read their settings at import time
+load_dotenv()
+
 import uvicorn
 from fastapi import FastAPI
-from src.routes.main_router import router as main_router
-from src.setup import load_embedding_function, load_vectorstore
+from src.routes.main_router import router as main_router, create_answer_chain
+from src.routes.batch_router import router as batch_router
+from src.models.utils import create_chat_openai_with_base, close_http_clients
+from src.models.context_router import create_context_chain, create_context_router
+from src.answer_cache import SemanticAnswerCache
+from src.metrics import METRICS_TIMING_HEADER, start_request_timings, format_server_timing
+from src.setup import load_embedding_function, load_vectorstore, open_store_client, refresh_vectorstore
 from apscheduler.schedulers.background import BackgroundScheduler
-from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import logging
 import os
 
-load_dotenv()
+# Set LOG_LEVEL=DEBUG to log retrieved contexts and full prompts
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper())
 
 # Initialize app
 app = FastAPI()
 
-# Store resources in app's state so they can be accessed in views
-app.state.EMBEDDINGFUNTION = load_embedding_function()
+# Store resources in app's state so they can be accessed in views.
+# The embedding model, context router and vectorstore are loaded in the background after
+# startup, the readiness endpoint reports which of them are available.
+app.state.RESOURCES = {"embedding": False, "context_router": False, "vectorstore": False}
+app.state.STARTUP_ERROR = None
+app.state.ANSWER_CACHE = SemanticAnswerCache()
+
+# LLM clients and chains are reused across requests, sharing pooled keep-alive connections per LLM server
+app.state.ANSWER_CHAIN = create_answer_chain(
+    create_chat_openai_with_base(
+        os.getenv("DEFAULT_CUSTOM_LLM_URL"),
+        openai_api_key="lm-studio",
+        max_tokens=int(os.getenv("ANSWER_MAX_TOKENS", "512")),
+    )
+)
+context_chain = create_context_chain(
+    create_chat_openai_with_base(os.getenv("MINI_CUSTOM_LLM_URL"), openai_api_key="lm-studio", max_tokens=128)
+)
 
 def update_vectorstore():
-    app.state.VECTORSTORE = load_vectorstore(app.state.EMBEDDINGFUNTION)
+    # Only documents that changed since the last run are embedded again. The new store is
+    # built next to the served one and swapped in by reassigning the reference, requests
+    # already running keep using the store they started with.
+    app.state.VECTORSTORE = refresh_vectorstore(app.state.VECTORSTORE, app.state.EMBEDDINGFUNTION)
+    # Cached answers may be based on outdated documents
+    app.state.ANSWER_CACHE.clear()
 
-update_vectorstore()
 scheduler = BackgroundScheduler()
 scheduler.add_job(update_vectorstore, 'interval', days=1)
 
+
+def load_resources():
+    try:
+        # The embedding model and the vectorstore client are loaded in parallel
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            embedding_future = executor.submit(load_embedding_function)
+            store_future = executor.submit(open_store_client)
+
+            app.state.EMBEDDINGFUNTION = embedding_future.result()
+            app.state.RESOURCES["embedding"] = True
+
+            app.state.CONTEXT_ROUTER = create_context_router(app.state.EMBEDDINGFUNTION, context_chain)
+            app.state.RESOURCES["context_router"] = True
+
+            # Builds the store from a Moodle crawl if none exists yet
+            app.state.VECTORSTORE = load_vectorstore(app.state.EMBEDDINGFUNTION, store_future.result())
+            app.state.RESOURCES["vectorstore"] = True
+
+        scheduler.start()
+        print("All resources loaded")
+    except Exception as e:
+        app.state.STARTUP_ERROR = repr(e)
+        logging.exception("Loading resources failed")
+
+
 # Register routes
 app.include_router(main_router)
+app.include_router(batch_router)
+
+
+if METRICS_TIMING_HEADER:
+    @app.middleware("http")
+    async def server_timing(request, call_next):
+        # Streaming responses send their headers before the answer is generated, so only
+        # stages finished before the first byte are reported for them
+        timings = start_request_timings()
+        response = await call_next(request)
+        if timings:
+            response.headers["Server-Timing"] = format_server_timing(timings)
+        return response
+
+
+@app.on_event("startup")
+def startup():
+    threading.Thread(target=load_resources, daemon=True).start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    if scheduler.running:
+        scheduler.shutdown(wait=False)
+    await close_http_clients()
 
 
 if __name__ == "__main__":
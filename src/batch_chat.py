@@ -0,0 +1,92 @@
+"""
+Answer a file of queries with the RAG pipeline and write the answers as json lines.
+
+Every input line is a json object with the fields of a chat query: "message" and optionally
+"course_id" and "usercontext". Every output line carries the "index" of its input line,
+lines are written in the order the answers complete.
+
+Usage:
+    python -m src.batch_chat questions.jsonl --output answers.jsonl --concurrency 8
+"""
+
+from dotenv import load_dotenv
+
+# Load the environment before importing modules that read their settings at import time
+load_dotenv()
+
+from src.routes.main_router import Query, create_answer_chain
+from src.routes.batch_router import abatch_chat, BATCH_LLM_CONCURRENCY, BATCH_MAX_QUERIES
+from src.models.utils import create_chat_openai_with_base, close_http_clients
+from src.models.context_router import create_context_chain, create_context_router
+from src.answer_cache import SemanticAnswerCache
+from src.setup import load_embedding_function, load_vectorstore
+from fastapi.encoders import jsonable_encoder
+from itertools import islice
+import argparse
+import asyncio
+import json
+import sys
+import os
+
+
+def read_queries(path):
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield Query(**json.loads(line))
+
+
+async def run(args, output):
+    embedding = load_embedding_function()
+    context_router = create_context_router(
+        embedding,
+        create_context_chain(
+            create_chat_openai_with_base(os.getenv("MINI_CUSTOM_LLM_URL"), openai_api_key="lm-studio", max_tokens=128)
+        ),
+    )
+    answer_chain = create_answer_chain(
+        create_chat_openai_with_base(
+            os.getenv("DEFAULT_CUSTOM_LLM_URL"),
+            openai_api_key="lm-studio",
+            max_tokens=int(os.getenv("ANSWER_MAX_TOKENS", "512")),
+        )
+    )
+    vectorstore = load_vectorstore(embedding)
+    # Without the cache every query is answered, also near duplicates within the file
+    answer_cache = SemanticAnswerCache() if args.answer_cache else None
+
+    queries = read_queries(args.input)
+    offset = 0
+    try:
+        # Queries are processed in batches, so large files are not held in memory at once
+        while batch := list(islice(queries, args.batch_size)):
+            async for result in abatch_chat(
+                batch, vectorstore, embedding, answer_chain, context_router, answer_cache, args.concurrency
+            ):
+                result.index += offset
+                output.write(json.dumps(jsonable_encoder(result)) + "\n")
+                output.flush()
+            offset += len(batch)
+    finally:
+        await close_http_clients()
+    print(f"Answered {offset} queries", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="json lines file with one query per line")
+    parser.add_argument("--output", help="File the answers are written to, stdout by default")
+    parser.add_argument("--concurrency", type=int, default=BATCH_LLM_CONCURRENCY, help="Concurrent LLM calls")
+    parser.add_argument("--batch-size", type=int, default=BATCH_MAX_QUERIES, help="Queries embedded and searched together")
+    parser.add_argument("--answer-cache", action="store_true", help="Reuse answers of similar queries")
+    args = parser.parse_args()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            asyncio.run(run(args, output))
+    else:
+        asyncio.run(run(args, sys.stdout))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+from html.parser import HTMLParser
+from functools import lru_cache
+from typing import Iterable, List
+import re
+import os
+
+CHUNKING_ENABLED = os.getenv("CHUNKING_ENABLED", "true").lower() == "true"
+# Chunk size and overlap in tokens of the embedding model, instructor-large reads at most 512 tokens
+CHUNK_SIZE_TOKENS = int(os.getenv("CHUNK_SIZE_TOKENS", "256"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "32"))
+CHUNK_TOKENIZER = os.getenv("CHUNK_TOKENIZER", "hkunlp/instructor-large")
+
+BLOCK_TAGS = {
+    "p", "div", "br", "li", "ul", "ol", "tr", "table", "section", "article",
+    "h1", "h2", "h3", "h4", "h5", "h6", "header", "footer", "blockquote", "pre",
+}
+SKIPPED_TAGS = {"script", "style", "head", "noscript", "template"}
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self.length = 0
+        self._skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self._skip_depth = max(self._skip_depth - 1, 0)
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self.parts.append(data)
+            self.length += len(data)
+
+
+def html_to_text(html: str) -> str:
+    return html_to_text_stream([html])
+
+
+def html_to_text_stream(chunks: Iterable[str], max_chars: int = 0) -> str:
+    """Extract the text of html fed in chunks, the html is never held in memory at once."""
+    extractor = _TextExtractor()
+    for chunk in chunks:
+        extractor.feed(chunk)
+        # Whitespace is collapsed afterwards, so twice the limit is kept before stopping
+        if max_chars and extractor.length > max_chars * 2:
+            break
+    extractor.close()
+    text = "".join(extractor.parts)
+    text = re.sub(r"[ \t\r\f\v]+", " ", text)
+    text = re.sub(r"\s*\n\s*", "\n", text).strip()
+    return text[:max_chars] if max_chars else text
+
+
+def looks_like_html(text: str) -> bool:
+    return bool(re.search(r"<(html|body|p|div|br|span|h[1-6]|table|ul|ol)\b", text[:2000], re.IGNORECASE))
+
+
+@lru_cache(maxsize=1)
+def get_tokenizer():
+    # The tokenizer of the embedding model makes chunk sizes match what the model actually reads
+    try:
+        from transformers import AutoTokenizer
+
+        return AutoTokenizer.from_pretrained(CHUNK_TOKENIZER)
+    except Exception as e:
+        print(f"Could not load tokenizer {CHUNK_TOKENIZER}, chunking by words: {e}")
+        return None
+
+
+def split_text(
+    text: str, chunk_size: int = CHUNK_SIZE_TOKENS, overlap: int = CHUNK_OVERLAP_TOKENS
+) -> List[str]:
+    """Split text into chunks of at most `chunk_size` tokens, consecutive chunks share `overlap` tokens."""
+    step = max(chunk_size - overlap, 1)
+    tokenizer = get_tokenizer()
+
+    if tokenizer is not None and tokenizer.is_fast:
+        offsets = tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True
+        )["offset_mapping"]
+        if len(offsets) <= chunk_size:
+            return [text] if text.strip() else []
+        chunks = []
+        for start in range(0, len(offsets), step):
+            window = offsets[start : start + chunk_size]
+            chunks.append(text[window[0][0] : window[-1][1]].strip())
+            if start + chunk_size >= len(offsets):
+                break
+        return [chunk for chunk in chunks if chunk]
+
+    # Without a tokenizer a word is counted as roughly one and a third tokens
+    words = text.split()
+    word_size = max(int(chunk_size * 0.75), 1)
+    word_step = max(int(step * 0.75), 1)
+    chunks = []
+    for start in range(0, len(words), word_step):
+        chunks.append(" ".join(words[start : start + word_size]))
+        if start + word_size >= len(words):
+            break
+    return chunks
+
+
+def count_tokens(text: str) -> int:
+    tokenizer = get_tokenizer()
+    if tokenizer is None:
+        # Roughly four characters per token
+        return len(text) // 4 + 1
+    return len(tokenizer(text, add_special_tokens=False)["input_ids"])
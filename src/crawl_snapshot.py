@@ -0,0 +1,168 @@
+from .scrape_moodle import (
+    MoodleSiteInfo,
+    MoodleCourse,
+    MoodleCourseSection,
+    MoodleModule,
+    MoodleModuleContent,
+    iter_course_objects,
+)
+from typing import Iterable, Iterator, List, Optional
+import hashlib
+import gzip
+import json
+import time
+import os
+
+# Every crawl writes a snapshot of the crawled objects, so the store can be re-indexed without crawling Moodle
+CRAWL_SNAPSHOT_ENABLED = os.getenv("CRAWL_SNAPSHOT_ENABLED", "true").lower() == "true"
+CRAWL_SNAPSHOT_DIRECTORY = os.getenv("CRAWL_SNAPSHOT_DIRECTORY", os.path.join("data", "crawl", "snapshots"))
+# Number of snapshots kept on disk, older ones are removed after a new one is written
+CRAWL_SNAPSHOT_KEEP = int(os.getenv("CRAWL_SNAPSHOT_KEEP", "3"))
+
+# Version 2 stores the filepath of file contents, which is part of their doc_id
+SNAPSHOT_FORMAT_VERSION = 2
+SNAPSHOT_PREFIX = "snapshot-"
+SNAPSHOT_SUFFIX = ".jsonl.gz"
+
+OBJECT_TYPES = {
+    "site": MoodleSiteInfo,
+    "course": MoodleCourse,
+    "section": MoodleCourseSection,
+    "module": MoodleModule,
+    "content": MoodleModuleContent,
+}
+TYPE_NAMES = {cls: name for name, cls in OBJECT_TYPES.items()}
+# Children are stored as records of their own and attached again when reading
+CHILD_FIELDS = {MoodleCourse: "sections", MoodleCourseSection: "modules", MoodleModule: "contents"}
+
+
+def to_record(obj) -> dict:
+    data = {key: value for key, value in vars(obj).items() if key not in ("courses", *CHILD_FIELDS.values())}
+    if isinstance(obj, MoodleSiteInfo):
+        # The site document lists the course names, the courses follow as records of their own
+        data["courses"] = [{"id": course.id, "name": course.name} for course in obj.courses]
+    return {
+        "type": TYPE_NAMES[type(obj)],
+        "doc_id": obj.doc_id(),
+        "parent_id": obj.asdict().get("parent_id"),
+        "timemodified": data.get("timemodified"),
+        "hash": hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest(),
+        "data": data,
+    }
+
+
+def from_record(record: dict):
+    # Attributes are restored as stored, the constructors would derive some of them from the environment
+    obj = OBJECT_TYPES[record["type"]].__new__(OBJECT_TYPES[record["type"]])
+    obj.__dict__.update(record["data"])
+    if isinstance(obj, MoodleSiteInfo):
+        obj.courses = [
+            MoodleCourse(id=course["id"], name=course["name"], sections=[]) for course in record["data"]["courses"]
+        ]
+    elif type(obj) in CHILD_FIELDS:
+        setattr(obj, CHILD_FIELDS[type(obj)], [])
+    return obj
+
+
+class CrawlSnapshotWriter:
+    """
+    Writes the crawled objects to a gzip compressed json lines file, one record per object.
+
+    The first line is a header with the format version. Records hold the object type, its
+    doc_id and parent_id, the timemodified reported by Moodle, a hash of the data and the
+    data itself. The file is written under a temporary name and only appears once complete.
+    """
+
+    def __init__(self, directory: str = CRAWL_SNAPSHOT_DIRECTORY, keep: int = CRAWL_SNAPSHOT_KEEP):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.keep = keep
+        self.path = os.path.join(directory, f"{SNAPSHOT_PREFIX}{time.strftime('%Y%m%d%H%M%S')}{SNAPSHOT_SUFFIX}")
+        self.count = 0
+        self._tmp_path = self.path + ".tmp"
+        self._file = gzip.open(self._tmp_path, "wt", encoding="utf-8")
+        self._write(
+            {"format_version": SNAPSHOT_FORMAT_VERSION, "created": time.time(), "moodle_url": os.getenv("MOODLE_URL")}
+        )
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def write(self, obj):
+        self._write(to_record(obj))
+        self.count += 1
+
+    def commit(self):
+        self._file.close()
+        os.replace(self._tmp_path, self.path)
+        print(f"Wrote crawl snapshot {self.path} with {self.count} objects")
+        if self.keep > 0:
+            for path in list_snapshots(self.directory)[: -self.keep]:
+                os.remove(path)
+
+    def abort(self):
+        self._file.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+def write_snapshot(objects: Iterable, directory: str = CRAWL_SNAPSHOT_DIRECTORY) -> Iterator:
+    """Pass the crawled objects through while writing them to a new snapshot, which is kept only if the crawl completes."""
+    writer = CrawlSnapshotWriter(directory)
+    try:
+        for obj in objects:
+            writer.write(obj)
+            yield obj
+    except BaseException:
+        writer.abort()
+        raise
+    writer.commit()
+
+
+def read_snapshot(path: str) -> Iterator:
+    """
+    Read a snapshot back as the objects yielded by `stream_moodle_data`.
+
+    Courses are rebuilt one at a time, a course is yielded with its sections, modules and
+    contents once all of its records are read.
+    """
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+        if header.get("format_version") != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported crawl snapshot format {header.get('format_version')} in {path}")
+
+        course, sections, modules = None, {}, {}
+        for line in f:
+            obj = from_record(json.loads(line))
+            if isinstance(obj, MoodleSiteInfo):
+                yield obj
+            elif isinstance(obj, MoodleCourse):
+                if course is not None:
+                    yield from iter_course_objects(course)
+                course, sections, modules = obj, {}, {}
+            elif isinstance(obj, MoodleCourseSection):
+                course.sections.append(obj)
+                sections[obj.id] = obj
+            elif isinstance(obj, MoodleModule):
+                sections[obj.section_id].modules.append(obj)
+                modules[obj.id] = obj
+            else:
+                modules[obj.module_id].contents.append(obj)
+        if course is not None:
+            yield from iter_course_objects(course)
+
+
+def list_snapshots(directory: str = CRAWL_SNAPSHOT_DIRECTORY) -> List[str]:
+    # Snapshots are named by creation time, so sorting by name sorts by age
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX)
+    )
+
+
+def latest_snapshot(directory: str = CRAWL_SNAPSHOT_DIRECTORY) -> Optional[str]:
+    snapshots = list_snapshots(directory)
+    return snapshots[-1] if snapshots else None
@@ -0,0 +1,166 @@
+from .chunking import html_to_text_stream
+from typing import Iterable, Iterator, Optional
+import threading
+import tempfile
+import hashlib
+import codecs
+import gzip
+import time
+import os
+
+# Files fetched in parallel, shared by all courses crawled at the same time
+FILE_FETCH_CONCURRENCY = int(os.getenv("MOODLE_FILE_FETCH_CONCURRENCY", "8"))
+# Files larger than this are indexed by filename only
+FILE_MAX_BYTES = int(os.getenv("MOODLE_FILE_MAX_BYTES", str(20 * 1024 * 1024)))
+# Maximum characters of text kept per file
+FILE_MAX_CHARS = int(os.getenv("MOODLE_FILE_MAX_CHARS", "200000"))
+# Extracted texts are cached on disk by url and timemodified
+FILE_CACHE_DIRECTORY = os.getenv("MOODLE_FILE_CACHE_DIRECTORY", os.path.join("data", "crawl", "files"))
+# Cached texts not used for this many days are removed, 0 keeps them forever
+FILE_CACHE_MAX_AGE_DAYS = float(os.getenv("MOODLE_FILE_CACHE_MAX_AGE_DAYS", "30"))
+
+FILE_CHUNK_SIZE = 64 * 1024
+
+FILE_KINDS = {
+    ".html": "html",
+    ".htm": "html",
+    ".txt": "text",
+    ".md": "text",
+    ".csv": "text",
+    ".pdf": "pdf",
+}
+MIMETYPE_KINDS = {"text/html": "html", "text/plain": "text", "text/markdown": "text", "application/pdf": "pdf"}
+
+
+class FileTooLarge(Exception):
+    pass
+
+
+def get_file_kind(filename: Optional[str], mimetype: Optional[str] = None) -> Optional[str]:
+    """Return how the text of a file is extracted, or None if it is indexed by filename only."""
+    extension = os.path.splitext(filename or "")[1].lower()
+    return FILE_KINDS.get(extension) or MIMETYPE_KINDS.get((mimetype or "").split(";")[0].strip())
+
+
+def _limit(chunks: Iterable[bytes], max_bytes: int) -> Iterator[bytes]:
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if max_bytes and size > max_bytes:
+            raise FileTooLarge(f"larger than {max_bytes} bytes")
+        yield chunk
+
+
+def _decode(chunks: Iterable[bytes], encoding: Optional[str]) -> Iterator[str]:
+    try:
+        decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+    except LookupError:
+        # Unknown charsets in the Content-Type header are read as utf-8, which Moodle serves
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+    yield decoder.decode(b"", final=True)
+
+
+def extract_text(
+    kind: str,
+    chunks: Iterable[bytes],
+    encoding: Optional[str] = None,
+    max_bytes: int = FILE_MAX_BYTES,
+    max_chars: int = FILE_MAX_CHARS,
+) -> Optional[str]:
+    """Extract the text of a file streamed in chunks of bytes, None if it can not be extracted."""
+    chunks = _limit(chunks, max_bytes)
+    if kind == "html":
+        return html_to_text_stream(_decode(chunks, encoding), max_chars)
+    if kind == "text":
+        parts, length = [], 0
+        for text in _decode(chunks, encoding):
+            parts.append(text)
+            length += len(text)
+            if max_chars and length >= max_chars:
+                break
+        text = "".join(parts).strip()
+        return text[:max_chars] if max_chars else text
+    if kind == "pdf":
+        # Pdf files are read with random access, large ones are spooled to disk
+        with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as file:
+            for chunk in chunks:
+                file.write(chunk)
+            file.seek(0)
+            return extract_pdf_text(file, max_chars)
+    return None
+
+
+_pypdf_missing_reported = False
+
+
+def extract_pdf_text(file, max_chars: int = FILE_MAX_CHARS) -> Optional[str]:
+    global _pypdf_missing_reported
+    try:
+        from pypdf import PdfReader
+    except ImportError:
+        if not _pypdf_missing_reported:
+            print("pypdf is not installed, pdf files are indexed by filename only")
+            _pypdf_missing_reported = True
+        return None
+    parts, length = [], 0
+    for page in PdfReader(file).pages:
+        text = page.extract_text() or ""
+        parts.append(text)
+        length += len(text)
+        if max_chars and length >= max_chars:
+            break
+    text = "\n".join(parts).strip()
+    return text[:max_chars] if max_chars else text
+
+
+class FileTextCache:
+    """
+    Keeps the extracted texts of Moodle files on disk, keyed by file url and timemodified.
+
+    A file is only downloaded again when its timemodified changes. Texts are stored gzip
+    compressed, one file per entry, so they are not held in memory between crawls.
+    """
+
+    def __init__(self, directory: str = FILE_CACHE_DIRECTORY):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, fileurl, timemodified):
+        key = hashlib.sha256(f"{fileurl}\n{timemodified}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, key[:2], key + ".txt.gz")
+
+    def get(self, fileurl, timemodified) -> Optional[str]:
+        # Without timemodified a changed file can not be detected, so it is always fetched
+        if timemodified is None:
+            return None
+        path = self._path(fileurl, timemodified)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        # The modification time marks the entry as used, see prune
+        os.utime(path)
+        return text
+
+    def put(self, fileurl, timemodified, text: str):
+        if timemodified is None:
+            return
+        path = self._path(fileurl, timemodified)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def prune(self, max_age_days: float = FILE_CACHE_MAX_AGE_DAYS):
+        if max_age_days <= 0:
+            return
+        cutoff = time.time() - max_age_days * 86400
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
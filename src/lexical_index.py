@@ -0,0 +1,231 @@
+from langchain.docstore.document import Document
+from collections import Counter
+from typing import Iterable, List, Optional, Tuple
+import threading
+import sqlite3
+import math
+import json
+import re
+import os
+
+# BM25 parameters
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+# Terms occurring in more than this share of all documents are ignored, they barely affect the ranking
+LEXICAL_MAX_DF_RATIO = float(os.getenv("LEXICAL_MAX_DF_RATIO", "0.2"))
+# Postings scored per query term, the ones with the highest term frequency are kept
+LEXICAL_MAX_POSTINGS_PER_TERM = int(os.getenv("LEXICAL_MAX_POSTINGS_PER_TERM", "1000"))
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+# Metadata fields stored as columns, so the filters of the retriever can be applied in sql
+FILTER_COLUMNS = ("doc_type", "course_id")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.casefold())
+
+
+class LexicalIndex:
+    """
+    A BM25 inverted index over the vectorstore documents, persisted in a sqlite file.
+
+    Documents are keyed by their doc_id, so the index is updated together with the
+    vectorstore on every sync. Searches support the `$eq`, `$in` and `$and` filters on
+    doc_type and course_id used for the chroma retriever.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        connection = self._connection()
+        connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS docs (
+                doc_id TEXT PRIMARY KEY,
+                doc_type TEXT,
+                course_id TEXT,
+                length INTEGER,
+                page_content TEXT,
+                metadata TEXT
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT,
+                doc_id TEXT,
+                tf INTEGER,
+                PRIMARY KEY (term, doc_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_doc_id ON postings (doc_id);
+            CREATE INDEX IF NOT EXISTS postings_term_tf ON postings (term, tf);
+            CREATE TABLE IF NOT EXISTS terms (
+                term TEXT PRIMARY KEY,
+                df INTEGER
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS stats (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                total INTEGER,
+                total_length INTEGER
+            );
+            """
+        )
+        if connection.execute("SELECT COUNT(*) FROM stats").fetchone()[0] == 0:
+            # Indexes written before the statistics were kept are counted once
+            connection.execute("INSERT INTO stats SELECT 0, COUNT(*), COALESCE(SUM(length), 0) FROM docs")
+            connection.execute("INSERT OR REPLACE INTO terms SELECT term, COUNT(*) FROM postings GROUP BY term")
+        connection.commit()
+
+    def _connection(self):
+        # sqlite connections can not be shared between threads, every thread opens its own
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            # Connections are closed by `close` from whichever thread releases the store
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def close(self):
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for connection in connections:
+            connection.close()
+        self._local = threading.local()
+
+    def count(self) -> int:
+        return self._connection().execute("SELECT total FROM stats").fetchone()[0]
+
+    def _remove(self, connection, doc_id) -> bool:
+        # Keeps the document frequencies and the corpus statistics in step with the postings
+        row = connection.execute("SELECT length FROM docs WHERE doc_id = ?", (doc_id,)).fetchone()
+        if row is None:
+            return False
+        connection.executemany(
+            "UPDATE terms SET df = df - 1 WHERE term = ?",
+            connection.execute("SELECT term FROM postings WHERE doc_id = ?", (doc_id,)).fetchall(),
+        )
+        connection.execute("DELETE FROM postings WHERE doc_id = ?", (doc_id,))
+        connection.execute("DELETE FROM docs WHERE doc_id = ?", (doc_id,))
+        connection.execute("UPDATE stats SET total = total - 1, total_length = total_length - ?", row)
+        return True
+
+    def upsert(self, documents: Iterable[Document]):
+        with self._write_lock:
+            connection = self._connection()
+            for doc in documents:
+                doc_id = doc.metadata["doc_id"]
+                terms = Counter(tokenize(doc.page_content))
+                self._remove(connection, doc_id)
+                connection.execute(
+                    "INSERT OR REPLACE INTO docs VALUES (?, ?, ?, ?, ?, ?)",
+                    (
+                        doc_id,
+                        doc.metadata.get("doc_type"),
+                        doc.metadata.get("course_id"),
+                        sum(terms.values()),
+                        doc.page_content,
+                        json.dumps(doc.metadata),
+                    ),
+                )
+                connection.executemany(
+                    "INSERT INTO postings VALUES (?, ?, ?)",
+                    [(term, doc_id, tf) for term, tf in terms.items()],
+                )
+                connection.executemany(
+                    "INSERT INTO terms VALUES (?, 1) ON CONFLICT (term) DO UPDATE SET df = df + 1",
+                    [(term,) for term in terms],
+                )
+                connection.execute(
+                    "UPDATE stats SET total = total + 1, total_length = total_length + ?", (sum(terms.values()),)
+                )
+            connection.execute("DELETE FROM terms WHERE df <= 0")
+            connection.commit()
+
+    def delete(self, ids: List[str]):
+        with self._write_lock:
+            connection = self._connection()
+            for id in ids:
+                self._remove(connection, id)
+            connection.execute("DELETE FROM terms WHERE df <= 0")
+            connection.commit()
+
+    def search(
+        self, query: str, k: int = 5, filter: Optional[dict] = None
+    ) -> List[Tuple[Document, float]]:
+        terms = list(set(tokenize(query)))
+        if not terms:
+            return []
+        connection = self._connection()
+        total, total_length = connection.execute("SELECT total, total_length FROM stats").fetchone()
+        if not total:
+            return []
+        average_length = total_length / total
+
+        placeholders = ",".join("?" * len(terms))
+        document_frequencies = dict(
+            connection.execute(f"SELECT term, df FROM terms WHERE term IN ({placeholders})", terms).fetchall()
+        )
+        idf = {
+            term: math.log(1 + (total - df + 0.5) / (df + 0.5))
+            for term, df in document_frequencies.items()
+            if df <= total * LEXICAL_MAX_DF_RATIO
+        }
+        if not idf:
+            return []
+
+        where, params = _filter_to_sql(filter)
+        scores = Counter()
+        for term, term_idf in idf.items():
+            # Only the postings with the highest term frequency are read, so frequent terms stay cheap
+            rows = connection.execute(
+                "SELECT p.doc_id, p.tf, d.length FROM postings p "
+                "JOIN docs d ON d.doc_id = p.doc_id "
+                "WHERE p.term = ?" + (f" AND {where}" if where else "") + " ORDER BY p.tf DESC LIMIT ?",
+                [term] + params + [LEXICAL_MAX_POSTINGS_PER_TERM],
+            ).fetchall()
+            for doc_id, tf, length in rows:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * length / (average_length or 1))
+                scores[doc_id] += term_idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+        top = scores.most_common(k)
+        if not top:
+            return []
+        placeholders = ",".join("?" * len(top))
+        documents = {
+            doc_id: Document(page_content=page_content, metadata=json.loads(metadata))
+            for doc_id, page_content, metadata in connection.execute(
+                f"SELECT doc_id, page_content, metadata FROM docs WHERE doc_id IN ({placeholders})",
+                [doc_id for doc_id, _ in top],
+            ).fetchall()
+        }
+        return [(documents[doc_id], score) for doc_id, score in top]
+
+
+def _filter_to_sql(filter: Optional[dict]):
+    if not filter:
+        return "", []
+    clauses, params = [], []
+    for key, condition in filter.items():
+        if key == "$and":
+            for sub_filter in condition:
+                clause, sub_params = _filter_to_sql(sub_filter)
+                clauses.append(f"({clause})")
+                params.extend(sub_params)
+            continue
+        if key not in FILTER_COLUMNS:
+            raise ValueError(f"Unsupported filter field for lexical search: {key}")
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for operator, value in condition.items():
+            if operator == "$eq":
+                clauses.append(f"d.{key} = ?")
+                params.append(value)
+            elif operator == "$in":
+                clauses.append(f"d.{key} IN ({','.join('?' * len(value))})")
+                params.extend(value)
+            else:
+                raise ValueError(f"Unsupported filter operator for lexical search: {operator}")
+    return " AND ".join(clauses), params
@@ -0,0 +1,67 @@
+from prometheus_client import Histogram, CONTENT_TYPE_LATEST, generate_latest
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+import time
+import os
+
+# Add a Server-Timing header with the duration of every stage to chat responses
+METRICS_TIMING_HEADER = os.getenv("METRICS_TIMING_HEADER", "false").lower() == "true"
+
+REQUEST_STAGE_SECONDS = Histogram(
+    "moodle_rag_request_stage_seconds",
+    "Duration of the stages of chat requests",
+    ["stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+PIPELINE_STAGE_SECONDS = Histogram(
+    "moodle_rag_pipeline_stage_seconds",
+    "Duration of the stages of crawling and indexing",
+    ["stage"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200),
+)
+
+# Stage durations of the current request, only collected when the timing header is enabled
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+
+
+def start_request_timings() -> Dict[str, float]:
+    # Tasks started by the request copy the context, so they all add to the same dict
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+
+def observe(stage: str, seconds: float):
+    REQUEST_STAGE_SECONDS.labels(stage).observe(seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage: str):
+    """Record the duration of a stage of a chat request."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+@contextmanager
+def timed_pipeline(stage: str):
+    """Record the duration of a stage of crawling or indexing."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        PIPELINE_STAGE_SECONDS.labels(stage).observe(time.perf_counter() - start)
+
+
+def format_server_timing(timings: Dict[str, float]) -> str:
+    return ", ".join(f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items())
+
+
+def render_metrics():
+    return generate_latest(), CONTENT_TYPE_LATEST
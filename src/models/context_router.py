@@ -0,0 +1,263 @@
+from langchain_core.prompts import ChatPromptTemplate
+from langchain.prompts import HumanMessagePromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from ..metrics import timed
+import numpy as np
+import asyncio
+import logging
+import json
+import re
+import os
+
+logger = logging.getLogger(__name__)
+
+# "centroid" predicts the context locally and asks the LLM only when unsure, "llm" always asks the LLM
+CONTEXT_ROUTER = os.getenv("CONTEXT_ROUTER", "centroid")
+# Minimum margin between the best and second best centroid similarity to trust the local prediction
+CONTEXT_ROUTER_MIN_CONFIDENCE = float(os.getenv("CONTEXT_ROUTER_MIN_CONFIDENCE", "0.03"))
+# Retrieve for the local prediction while the LLM fallback is running
+CONTEXT_ROUTER_SPECULATIVE = os.getenv("CONTEXT_ROUTER_SPECULATIVE", "true").lower() == "true"
+# Optional json file mapping each context to a list of example queries
+CONTEXT_ROUTER_EXAMPLES = os.getenv("CONTEXT_ROUTER_EXAMPLES", "")
+
+EXAMPLE_QUERIES = {
+    "Site-Context": [
+        "Welche Kurse kann ich auf dieser Plattform belegen?",
+        "Welche Kurse gibt es?",
+        "Gibt es Kurse zum Thema künstliche Intelligenz?",
+        "Was ist das für eine Plattform?",
+        "Welche Angebote hat die Plattform?",
+        "Kannst du mir einen Kurs zum Programmieren empfehlen?",
+        "Which courses are available?",
+    ],
+    "Course-Context": [
+        "Fasse das Feedback zum Kurs zusammen",
+        "Worum geht es in diesem Kurs?",
+        "Welche Themen werden in diesem Kurs behandelt?",
+        "Welche Materialien gibt es in diesem Abschnitt?",
+        "Wo finde ich die Aufgabe zu Kapitel 2?",
+        "Erkläre mir den Inhalt der ersten Lektion",
+        "What is this course about?",
+    ],
+    "User-Context": [
+        "Welche Kurse habe ich bereits abgeschlossen?",
+        "Wie ist mein Lernfortschritt?",
+        "Welche Kurse passen zu meinen Interessen?",
+        "In welche Kurse bin ich eingeschrieben?",
+        "Was sind meine Lernziele?",
+        "Which courses have I completed?",
+    ],
+}
+
+
+CONTEXT_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        HumanMessagePromptTemplate.from_template(
+            (   
+                "User Query: {query}\n"
+                "User Context: {usercontext}\n"
+                "\n"
+                "Based on the previous query choose which sources are most relevant to answer the user query.\n"
+                "\n"
+                "Choose one of the following options, by reffering to its name only:\n"
+                "[Site-Context]: Includes general information about the site, its features and course offerings.\n"
+                "[Course-Context]: Includes information about a single specific course and its contents.\n"
+                "[User-Context]: Includes information about the current user, its bio, learning activity and interests and goals."
+            )
+        ),
+    ]
+)
+
+
+def create_context_chain(model):
+    return CONTEXT_PROMPT | model | StrOutputParser()
+
+
+def predict_context(request, context_chain):
+    logger.debug("Prompt: %s", CONTEXT_PROMPT.format_prompt(query = request.message, usercontext = request.usercontext))
+
+    answer = context_chain.invoke({"query": request.message, "usercontext": request.usercontext})
+    return parse_predicted_context(answer)
+
+
+async def apredict_context(request, context_chain):
+    logger.debug("Prompt: %s", CONTEXT_PROMPT.format_prompt(query = request.message, usercontext = request.usercontext))
+
+    answer = await context_chain.ainvoke({"query": request.message, "usercontext": request.usercontext})
+    return parse_predicted_context(answer)
+
+
+def parse_predicted_context(answer):
+    logger.debug("Answer: %s", answer)
+    # get only content that matches the desired output [Site-Context] or [Course-Context] or [User-Context]
+
+    match = re.search(r"\[(.*?)\]", answer)
+    if match:
+        predicted_context = match.group(1)
+    else:
+        return None
+
+    logger.debug("Predicted context: %s", predicted_context)
+
+    return predicted_context
+
+
+class LLMContextRouter:
+    """Predicts the context by asking the LLM on every request."""
+
+    def __init__(self, context_chain):
+        self.context_chain = context_chain
+
+    async def apredict(self, request, query_embedding=None):
+        with timed("context_prediction_llm"):
+            return await apredict_context(request, self.context_chain)
+
+    async def aroute(self, request, query_embedding, retrieve):
+        predicted_context = await self.apredict(request, query_embedding)
+        return predicted_context, await retrieve(predicted_context)
+
+    def stats(self):
+        return {"router": "llm"}
+
+
+class CentroidContextRouter:
+    """
+    Predicts the context locally by comparing the query embedding to the centroids of labelled example queries.
+
+    If the margin between the best and the second best centroid is below `min_confidence`
+    the fallback router is asked instead. With `speculative` enabled, retrieval for the local
+    prediction runs while the fallback is running and is kept if both agree.
+    """
+
+    def __init__(
+        self,
+        embedding,
+        fallback=None,
+        examples=None,
+        min_confidence: float = CONTEXT_ROUTER_MIN_CONFIDENCE,
+        speculative: bool = CONTEXT_ROUTER_SPECULATIVE,
+    ):
+        examples = examples or EXAMPLE_QUERIES
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+        self.speculative = speculative
+        self.labels = list(examples)
+        centroids = []
+        for label in self.labels:
+            vectors = _normalize(np.asarray([embedding.embed_query(query) for query in examples[label]]))
+            centroids.append(vectors.mean(axis=0))
+        self.centroids = _normalize(np.asarray(centroids))
+        self.local = 0
+        self.fallbacks = 0
+        self.speculation_hits = 0
+
+    def classify(self, query_embedding):
+        with timed("context_prediction"):
+            return self._classify(query_embedding)
+
+    def _classify(self, query_embedding):
+        vector = _normalize(np.asarray(query_embedding, dtype=np.float32))
+        scores = self.centroids @ vector
+        ranking = np.argsort(scores)[::-1]
+        confidence = float(scores[ranking[0]] - scores[ranking[1]]) if len(ranking) > 1 else 1.0
+        return self.labels[ranking[0]], confidence
+
+    def _is_confident(self, confidence):
+        return self.fallback is None or confidence >= self.min_confidence
+
+    async def apredict(self, request, query_embedding):
+        label, confidence = self.classify(query_embedding)
+        logger.debug("Local context prediction %s with confidence %.3f", label, confidence)
+        if self._is_confident(confidence):
+            self.local += 1
+            return label
+        self.fallbacks += 1
+        return await self.fallback.apredict(request, query_embedding)
+
+    async def aroute(self, request, query_embedding, retrieve):
+        label, confidence = self.classify(query_embedding)
+        logger.debug("Local context prediction %s with confidence %.3f", label, confidence)
+        if self._is_confident(confidence):
+            self.local += 1
+            return label, await retrieve(label)
+
+        self.fallbacks += 1
+        if not self.speculative:
+            predicted_context = await self.fallback.apredict(request, query_embedding)
+            return predicted_context, await retrieve(predicted_context)
+
+        speculative_retrieval = asyncio.ensure_future(retrieve(label))
+        try:
+            predicted_context = await self.fallback.apredict(request, query_embedding)
+        except BaseException:
+            speculative_retrieval.cancel()
+            raise
+        if predicted_context == label:
+            self.speculation_hits += 1
+            return predicted_context, await speculative_retrieval
+        speculative_retrieval.cancel()
+        return predicted_context, await retrieve(predicted_context)
+
+    def stats(self):
+        return {
+            "router": "centroid",
+            "local": self.local,
+            "fallbacks": self.fallbacks,
+            "speculation_hits": self.speculation_hits,
+        }
+
+
+def create_context_router(embedding, context_chain):
+    llm_router = LLMContextRouter(context_chain)
+    if CONTEXT_ROUTER == "llm":
+        return llm_router
+
+    examples = None
+    if CONTEXT_ROUTER_EXAMPLES:
+        with open(CONTEXT_ROUTER_EXAMPLES, "r", encoding="utf-8") as f:
+            examples = json.load(f)
+    return CentroidContextRouter(embedding, fallback=llm_router, examples=examples)
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+# Query example for preselectioon relevant context for user query:
+
+# Example 1:
+
+# User Query: Welche Kurse kann ich auf dieser Plattform belegen?
+# User Context: The user visits the site as a guest. The user currently views the homepage of the site.
+
+# Based on the previous query choose which sources are most relevant to answer the user query.
+
+# Choose one of the following options, by reffering to its name only:
+# [Site-Context]: Includes general information about the site, its features and course offerings.
+# [Course-Context]: Includes information about a single specific course and its contents.
+# [User-Context]: Includes information about the current user.
+
+# Example 2:
+
+# User Query: Fasse das Feedback zum Kurs zusammen,
+# User Context: The user is logged in as a teacher. The user currently views the course overview.
+
+# Based on the previous query choose which sources are most relevant to answer the user query.
+
+# Choose one of the following options, by reffering to its name only:
+# [Site-Context]: Includes general information about the site, its features and course offerings.
+# [Course-Context]: Includes information about a single specific course and its contents.
+# [User-Context]: Includes information about the current user, its bio, learning activity and interests and goals.
+
+# Example 3:
+
+# User Query: Welche Kurse habe ich bereits abgeschlossen?
+# User Context: The user is logged in as a student. The user currently views the dashboard.
+
+# Based on the previous query choose which sources are most relevant to answer the user query.
+
+# Choose one of the following options, by reffering to its name only:
+# [Site-Context]: Includes general information about the site, its features and course offerings.
+# [Course-Context]: Includes information about a single specific course and its contents.
+# [User-Context]: Includes information about the current user, its bio, learning activity and interests and goals.
\ No newline at end of file
@@ -0,0 +1,516 @@
+from langchain_core.embeddings import Embeddings
+from collections import OrderedDict
+from concurrent.futures import Future, InvalidStateError
+from typing import List, Optional
+import numpy as np
+import threading
+import asyncio
+import queue
+import sqlite3
+import hashlib
+import json
+import time
+import os
+
+# Query embedding cache settings, a size of 0 disables the cache
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", "1024"))
+# Seconds a cached query embedding stays valid, 0 keeps entries until they are evicted
+QUERY_EMBEDDING_CACHE_TTL = float(os.getenv("QUERY_EMBEDDING_CACHE_TTL", "86400"))
+# Optional sqlite file that keeps cached query embeddings across restarts
+QUERY_EMBEDDING_CACHE_PATH = os.getenv("QUERY_EMBEDDING_CACHE_PATH", "")
+# Directory holding the exported onnx model, it is exported on first use if missing
+EMBEDDING_ONNX_PATH = os.getenv("EMBEDDING_ONNX_PATH", os.path.join("data", "models", "instructor-large-onnx"))
+EMBEDDING_ONNX_BATCH_SIZE = int(os.getenv("EMBEDDING_ONNX_BATCH_SIZE", "32"))
+# Milliseconds a query waits for other queries to be embedded in the same batch, 0 disables batching
+QUERY_BATCH_MAX_WAIT_MS = float(os.getenv("QUERY_BATCH_MAX_WAIT_MS", "5"))
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", "32"))
+# Sqlite file caching document embeddings across store rebuilds, empty disables the cache
+DOCUMENT_EMBEDDING_CACHE_PATH = os.getenv(
+    "DOCUMENT_EMBEDDING_CACHE_PATH", os.path.join("data", "cache", "document_embeddings.sqlite3")
+)
+# Cached document embeddings not used for this many days are removed, 0 keeps them forever
+DOCUMENT_EMBEDDING_CACHE_MAX_AGE_DAYS = float(os.getenv("DOCUMENT_EMBEDDING_CACHE_MAX_AGE_DAYS", "30"))
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Wraps an embedding function and caches query embeddings in an LRU cache.
+
+    Queries are keyed on the model name, the query instruction and the query text with
+    whitespace collapsed and case folded. Entries expire after `ttl` seconds and can
+    optionally be persisted to a sqlite file. Document embeddings are passed through.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        maxsize: int = QUERY_EMBEDDING_CACHE_SIZE,
+        ttl: float = QUERY_EMBEDDING_CACHE_TTL,
+        path: Optional[str] = QUERY_EMBEDDING_CACHE_PATH,
+    ):
+        self.embeddings = embeddings
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+
+    def _key(self, text):
+        model_name = getattr(self.embeddings, "model_name", "")
+        instruction = getattr(self.embeddings, "query_instruction", "")
+        normalized = " ".join(text.split()).casefold()
+        payload = f"{model_name}\n{instruction}\n{normalized}"
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _is_expired(self, created):
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def _get_db(self):
+        # Opened lazily, processes that never embed queries do not touch the file
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS query_embeddings "
+                "(key TEXT PRIMARY KEY, created REAL, vector TEXT)"
+            )
+            if self.ttl > 0:
+                self._db.execute(
+                    "DELETE FROM query_embeddings WHERE created < ?",
+                    (time.time() - self.ttl,),
+                )
+            self._db.commit()
+        return self._db
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None and self.path:
+                row = self._get_db().execute(
+                    "SELECT created, vector FROM query_embeddings WHERE key = ?", (key,)
+                ).fetchone()
+                if row:
+                    entry = (row[0], json.loads(row[1]))
+                    self._cache[key] = entry
+            if entry is None:
+                return None
+            created, vector = entry
+            if self._is_expired(created):
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            self._evict()
+            return vector
+
+    def _put(self, key, vector):
+        created = time.time()
+        with self._lock:
+            self._cache[key] = (created, vector)
+            self._cache.move_to_end(key)
+            self._evict()
+            if self.path:
+                self._get_db().execute(
+                    "INSERT OR REPLACE INTO query_embeddings VALUES (?, ?, ?)",
+                    (key, created, json.dumps(vector)),
+                )
+                self._get_db().commit()
+
+    def _evict(self):
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        vector = self._get(key)
+        if vector is not None:
+            self.hits += 1
+            return vector
+        self.misses += 1
+        vector = self.embeddings.embed_query(text)
+        self._put(key, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        vector = self._get(key)
+        if vector is not None:
+            self.hits += 1
+            return vector
+        self.misses += 1
+        vector = await self.embeddings.aembed_query(text)
+        self._put(key, vector)
+        return vector
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        vectors = [self._get(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            for i, vector in zip(missing, embed_queries(self.embeddings, [texts[i] for i in missing])):
+                vectors[i] = vector
+                self._put(keys[i], vector)
+        return vectors
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            if self.path:
+                self._get_db().execute("DELETE FROM query_embeddings")
+                self._get_db().commit()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._cache),
+            "maxsize": self.maxsize,
+        }
+
+
+def embed_queries(embeddings, texts: List[str]) -> List[List[float]]:
+    """Embed several queries in one forward pass where the embedding function supports it."""
+    if hasattr(embeddings, "embed_queries"):
+        return embeddings.embed_queries(texts)
+    if hasattr(embeddings, "client") and hasattr(embeddings, "query_instruction"):
+        # HuggingFaceInstructEmbeddings only embeds single queries, batch them through its model
+        instruction_pairs = [[embeddings.query_instruction, text] for text in texts]
+        return embeddings.client.encode(instruction_pairs, **embeddings.encode_kwargs).tolist()
+    return [embeddings.embed_query(text) for text in texts]
+
+
+class DocumentEmbeddingCache:
+    """
+    Persists document embeddings in a sqlite file, keyed by a hash of the model and the text.
+
+    The model key identifies the model, backend and embed instruction, so vectors of a
+    different model are never reused. Vectors are stored as float32 blobs. Entries that
+    were not used for `max_age_days` are removed when the cache is opened.
+    """
+
+    def __init__(
+        self,
+        model_key: str,
+        path: str = DOCUMENT_EMBEDDING_CACHE_PATH,
+        max_age_days: float = DOCUMENT_EMBEDDING_CACHE_MAX_AGE_DAYS,
+    ):
+        self.model_key = model_key
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS document_embeddings "
+            "(key TEXT PRIMARY KEY, last_used REAL, vector BLOB)"
+        )
+        if max_age_days > 0:
+            self._db.execute(
+                "DELETE FROM document_embeddings WHERE last_used < ?",
+                (time.time() - max_age_days * 86400,),
+            )
+        self._db.commit()
+
+    def key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_key}\n{text}".encode("utf-8")).hexdigest()
+
+    def get_many(self, texts: List[str]) -> List[Optional[List[float]]]:
+        keys = [self.key(text) for text in texts]
+        found = {}
+        with self._lock:
+            # Looked up in chunks, sqlite limits the number of parameters of a query
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                found.update(
+                    self._db.execute(
+                        f"SELECT key, vector FROM document_embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                        chunk,
+                    ).fetchall()
+                )
+            if found:
+                self._db.executemany(
+                    "UPDATE document_embeddings SET last_used = ? WHERE key = ?",
+                    [(time.time(), key) for key in found],
+                )
+                self._db.commit()
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return [
+            np.frombuffer(found[key], dtype=np.float32).tolist() if key in found else None for key in keys
+        ]
+
+    def put_many(self, texts: List[str], vectors: List[List[float]]):
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO document_embeddings VALUES (?, ?, ?)",
+                [
+                    (self.key(text), now, np.asarray(vector, dtype=np.float32).tobytes())
+                    for text, vector in zip(texts, vectors)
+                ],
+            )
+            self._db.commit()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def _resolve(future: Future, result=None, exception: Optional[BaseException] = None):
+    if future.done():
+        return
+    try:
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class MicroBatchingEmbeddings(Embeddings):
+    """
+    Collects queries from concurrent requests and embeds them together.
+
+    A query waits at most `max_wait_ms` for other queries before its batch is embedded by a
+    background thread, batches hold at most `max_batch_size` queries. Document embeddings
+    are passed through.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        max_wait_ms: float = QUERY_BATCH_MAX_WAIT_MS,
+        max_batch_size: int = QUERY_BATCH_MAX_SIZE,
+    ):
+        self.embeddings = embeddings
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.batches = 0
+        self.queries = 0
+        self._queue = queue.Queue()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # Expose attributes like model_name and query_instruction of the wrapped embeddings
+        if name == "embeddings":
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    def _submit(self, text) -> Future:
+        with self._lock:
+            # Started lazily, processes that only embed documents never start the thread
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def _take(self, timeout=None):
+        text, future = self._queue.get(timeout=timeout)
+        # Queries of cancelled requests, e.g. of disconnected clients, are dropped before they are embedded
+        return (text, future) if future.set_running_or_notify_cancel() else None
+
+    def _next_batch(self):
+        batch = []
+        while not batch:
+            item = self._take()
+            if item is not None:
+                batch.append(item)
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self._take(timeout)
+            except queue.Empty:
+                break
+            if item is not None:
+                batch.append(item)
+        return batch
+
+    def _run(self):
+        # Nothing may end this thread, queries queued afterwards would wait forever
+        while True:
+            batch = []
+            try:
+                batch = self._next_batch()
+                vectors = embed_queries(self.embeddings, [text for text, _ in batch])
+                self.batches += 1
+                self.queries += len(batch)
+                for (_, future), vector in zip(batch, vectors):
+                    _resolve(future, result=vector)
+            except Exception as e:
+                for _, future in batch:
+                    _resolve(future, exception=e)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._submit(text).result()
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return await asyncio.wrap_future(self._submit(text))
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        # Already a batch, it is embedded directly instead of being queued
+        return embed_queries(self.embeddings, texts)
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "queries": self.queries,
+            "average_batch_size": self.queries / self.batches if self.batches else 0,
+        }
+
+
+class OnnxInstructorEmbeddings(Embeddings):
+    """
+    Instructor embeddings computed with an onnx export of the T5 encoder, optionally int8 quantized.
+
+    Mirrors the INSTRUCTOR pipeline: the instruction is prepended to the text, the instruction
+    tokens are excluded from mean pooling, and the pooled output is projected by the model's
+    dense layer and normalized. Requires the optional onnxruntime package.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        query_instruction: str,
+        embed_instruction: str,
+        onnx_path: str = EMBEDDING_ONNX_PATH,
+        quantize: bool = False,
+        batch_size: int = EMBEDDING_ONNX_BATCH_SIZE,
+        max_length: int = 512,
+    ):
+        import onnxruntime
+        from huggingface_hub import snapshot_download
+        from transformers import AutoTokenizer
+
+        self.model_name = model_name
+        self.query_instruction = query_instruction
+        self.embed_instruction = embed_instruction
+        self.batch_size = batch_size
+        self.max_length = max_length
+
+        model_dir = snapshot_download(model_name)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.dense_weight = _load_dense_weight(model_dir)
+
+        model_file = os.path.join(onnx_path, "encoder.onnx")
+        if not os.path.exists(model_file):
+            export_onnx_encoder(model_dir, model_file)
+        if quantize:
+            quantized_file = os.path.join(onnx_path, "encoder.int8.onnx")
+            if not os.path.exists(quantized_file):
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+
+                quantize_dynamic(model_file, quantized_file, weight_type=QuantType.QInt8)
+            model_file = quantized_file
+
+        self.session = onnxruntime.InferenceSession(
+            model_file, providers=["CPUExecutionProvider"]
+        )
+
+    def _embed(self, instruction: str, texts: List[str]) -> List[List[float]]:
+        # The trailing eos token of the instruction is not part of the prompt in the combined text
+        instruction_length = len(self.tokenizer(instruction)["input_ids"]) - 1
+        embeddings = []
+        for i in range(0, len(texts), self.batch_size):
+            batch = [instruction + text for text in texts[i : i + self.batch_size]]
+            encoded = self.tokenizer(
+                batch,
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np",
+            )
+            attention_mask = encoded["attention_mask"].astype(np.int64)
+            (hidden_states,) = self.session.run(
+                ["last_hidden_state"],
+                {
+                    "input_ids": encoded["input_ids"].astype(np.int64),
+                    "attention_mask": attention_mask,
+                },
+            )
+            pooling_mask = attention_mask.copy()
+            pooling_mask[:, :instruction_length] = 0
+            pooling_mask = pooling_mask[:, :, None].astype(np.float32)
+            pooled = (hidden_states * pooling_mask).sum(axis=1) / np.clip(
+                pooling_mask.sum(axis=1), 1e-9, None
+            )
+            vectors = pooled @ self.dense_weight.T
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+            embeddings.extend(vectors.tolist())
+        return embeddings
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(self.embed_instruction, texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(self.query_instruction, [text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        return self._embed(self.query_instruction, texts)
+
+
+def _load_dense_weight(model_dir):
+    import torch
+
+    state_dict = torch.load(
+        os.path.join(model_dir, "2_Dense", "pytorch_model.bin"), map_location="cpu"
+    )
+    return state_dict["linear.weight"].numpy()
+
+
+def export_onnx_encoder(model_dir, model_file):
+    import torch
+    from transformers import T5EncoderModel
+
+    print("Exporting embedding model to " + model_file)
+    directory = os.path.dirname(model_file)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    encoder = T5EncoderModel.from_pretrained(model_dir)
+    encoder.eval()
+    input_ids = torch.ones((1, 8), dtype=torch.long)
+    attention_mask = torch.ones((1, 8), dtype=torch.long)
+    with torch.no_grad():
+        torch.onnx.export(
+            encoder,
+            (input_ids, attention_mask),
+            model_file,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "last_hidden_state": {0: "batch", 1: "sequence"},
+            },
+            opset_version=14,
+        )
+
+
+def quantize_torch_embeddings(embedding):
+    """Replace the linear layers of a HuggingFaceInstructEmbeddings model with dynamically quantized int8 layers."""
+    import torch
+
+    embedding.client = torch.quantization.quantize_dynamic(
+        embedding.client, {torch.nn.Linear}, dtype=torch.qint8
+    )
+    return embedding
@@ -1,6 +1,45 @@
 from langchain_openai import ChatOpenAI
+import threading
+import httpx
+import os
+
+# Connection pool settings for the http clients talking to the LLM servers
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+
+_http_clients = {}
+_http_clients_lock = threading.Lock()
+
+
+def get_http_clients(openai_api_base):
+    # One sync and one async client per base url, so every model on the same server shares its keep-alive connections.
+    with _http_clients_lock:
+        if openai_api_base not in _http_clients:
+            limits = httpx.Limits(
+                max_connections=LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+            )
+            _http_clients[openai_api_base] = (
+                httpx.Client(limits=limits, timeout=LLM_TIMEOUT),
+                httpx.AsyncClient(limits=limits, timeout=LLM_TIMEOUT),
+            )
+        return _http_clients[openai_api_base]
+
+
+async def close_http_clients():
+    with _http_clients_lock:
+        clients = list(_http_clients.values())
+        _http_clients.clear()
+    for http_client, http_async_client in clients:
+        http_client.close()
+        await http_async_client.aclose()
+
 
 def create_chat_openai_with_base(openai_api_base, openai_api_key="-", max_tokens=512):
+    http_client, http_async_client = get_http_clients(openai_api_base)
     return ChatOpenAI(
         model="-",
         openai_api_base=openai_api_base,
@@ -8,4 +47,6 @@ def create_chat_openai_with_base(openai_api_base, openai_api_key="-", max_tokens
         temperature=0.1,
         max_tokens=max_tokens,
         model_kwargs={"seed": 42},
+        http_client=http_client,
+        http_async_client=http_async_client,
     )
\ No newline at end of file
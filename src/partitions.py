@@ -0,0 +1,119 @@
+from langchain_community.vectorstores import Chroma
+from chromadb.config import Settings
+from typing import List, Optional
+import threading
+import os
+
+# Keep a site partition and one partition per course next to the global collection
+PARTITIONS_ENABLED = os.getenv("PARTITIONS_ENABLED", "true").lower() == "true"
+
+SITE_PARTITION = "partition_site"
+SITE_DOC_TYPES = ("site", "course")
+COURSE_PARTITION_PREFIX = "partition_course_"
+
+
+def course_partition(course_id) -> str:
+    return f"{COURSE_PARTITION_PREFIX}{course_id}"
+
+
+def get_partition_filter(name: str) -> dict:
+    # Selects the documents of a partition in the lexical index, which is shared by all partitions
+    if name == SITE_PARTITION:
+        return {"doc_type": {"$in": list(SITE_DOC_TYPES)}}
+    return {"course_id": {"$eq": name[len(COURSE_PARTITION_PREFIX) :]}}
+
+
+def get_partition_names(metadata: dict) -> List[str]:
+    names = []
+    if metadata.get("doc_type") in SITE_DOC_TYPES:
+        names.append(SITE_PARTITION)
+    if metadata.get("course_id") not in (None, "None"):
+        names.append(course_partition(metadata["course_id"]))
+    return names
+
+
+class PartitionLexicalIndex:
+    """Searches the shared lexical index within the documents of one partition."""
+
+    def __init__(self, lexical_index, partition_filter: dict):
+        self.lexical_index = lexical_index
+        self.partition_filter = partition_filter
+
+    def search(self, query: str, k: int = 5, filter: Optional[dict] = None):
+        filter = {"$and": [self.partition_filter, filter]} if filter else self.partition_filter
+        return self.lexical_index.search(query, k, filter)
+
+
+class VectorStorePartitions:
+    """
+    Per-site and per-course collections holding copies of the vectors of the global collection.
+
+    Site-Context queries only search the site and course documents, Course-Context queries
+    only the vectors of a single course, instead of filtering the whole index. The
+    partitions are written with the embeddings computed for the global collection, so they
+    add no embedding cost.
+    """
+
+    def __init__(self, client, embedding, lexical_index=None):
+        self.client = client
+        self.embedding = embedding
+        self.lexical_index = lexical_index
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Chroma:
+        with self._lock:
+            if name not in self._stores:
+                store = Chroma(
+                    client=self.client,
+                    collection_name=name,
+                    embedding_function=self.embedding,
+                    client_settings=Settings(anonymized_telemetry=False),
+                    collection_metadata={"hnsw:space": "cosine"},
+                )
+                # Partitions share the lexical index of the global collection, it filters in sql
+                store.lexical_index = (
+                    PartitionLexicalIndex(self.lexical_index, get_partition_filter(name))
+                    if self.lexical_index is not None
+                    else None
+                )
+                self._stores[name] = store
+            return self._stores[name]
+
+    def exists(self, name: str) -> bool:
+        try:
+            self.client.get_collection(name)
+            return True
+        except ValueError:
+            return False
+
+    def upsert(self, ids, embeddings, metadatas, documents):
+        groups = {}
+        for index, metadata in enumerate(metadatas):
+            for name in get_partition_names(metadata):
+                groups.setdefault(name, []).append(index)
+        for name, indices in groups.items():
+            self.get(name)._collection.upsert(
+                ids=[ids[i] for i in indices],
+                embeddings=[embeddings[i] for i in indices],
+                metadatas=[metadatas[i] for i in indices],
+                documents=[documents[i] for i in indices],
+            )
+
+    def delete(self, ids, metadatas):
+        groups = {}
+        for id, metadata in zip(ids, metadatas):
+            for name in get_partition_names(metadata or {}):
+                groups.setdefault(name, []).append(id)
+        for name, partition_ids in groups.items():
+            self.get(name).delete(ids=partition_ids)
+
+    def select(self, predicted_context: Optional[str], course_id: Optional[str]) -> Optional[Chroma]:
+        """Return the partition matching the predicted context, or None to search the global collection."""
+        if predicted_context == "Site-Context":
+            return self.get(SITE_PARTITION)
+        if predicted_context == "Course-Context" and course_id:
+            name = course_partition(course_id)
+            # Unknown courses fall back to the global collection instead of creating empty partitions
+            return self.get(name) if name in self._stores or self.exists(name) else None
+        return None
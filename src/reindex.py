@@ -0,0 +1,66 @@
+"""
+Re-index the vectorstore from a crawl snapshot, without crawling Moodle.
+
+The new store version is built, validated and swapped in like the daily update. A running
+server keeps serving the store it loaded until its next update or restart, that version is
+not removed while the server has it open. Updates of the server and of this tool take turns.
+
+Usage:
+    python -m src.reindex                     # Sync the store with the latest snapshot
+    python -m src.reindex --rebuild           # Embed every document again, e.g. after changing the model
+    python -m src.reindex --snapshot data/crawl/snapshots/snapshot-20240101000000.jsonl.gz
+    python -m src.reindex --crawl-only        # Crawl Moodle and write a new snapshot without indexing
+    python -m src.reindex --list              # List the available snapshots
+"""
+
+from dotenv import load_dotenv
+
+# Load the environment before importing modules that read their settings at import time
+load_dotenv()
+
+from src.crawl_snapshot import write_snapshot, list_snapshots, latest_snapshot
+from src.scrape_moodle import stream_moodle_data
+from src.setup import (
+    load_embedding_function,
+    open_store_client,
+    open_vectorstore,
+    refresh_vectorstore,
+    VECTORSTORE_UPDATE_MODE,
+)
+import argparse
+import sys
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--snapshot", help="Snapshot to index, the latest one by default")
+    parser.add_argument("--rebuild", action="store_true", help="Build the new version from an empty store")
+    parser.add_argument("--crawl-only", action="store_true", help="Only crawl Moodle and write a snapshot")
+    parser.add_argument("--list", action="store_true", help="List the available snapshots")
+    args = parser.parse_args()
+
+    if args.list:
+        for path in list_snapshots():
+            print(path)
+        return
+
+    if args.crawl_only:
+        for _ in write_snapshot(stream_moodle_data()):
+            pass
+        return
+
+    snapshot = args.snapshot or latest_snapshot()
+    if snapshot is None:
+        sys.exit("No crawl snapshot found, run with --crawl-only first")
+
+    embedding = load_embedding_function(cache=False, batching=False)
+    persist_directory, client, _ = open_store_client()
+    db = open_vectorstore(embedding, persist_directory, client)
+    new_db = refresh_vectorstore(db, embedding, snapshot=snapshot, rebuild=args.rebuild)
+    # Only in place updates return the store they were given
+    if new_db is db and (args.rebuild or VECTORSTORE_UPDATE_MODE != "inplace"):
+        sys.exit("The new vectorstore version failed validation, the current version is kept")
+
+
+if __name__ == "__main__":
+    main()
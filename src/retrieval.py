@@ -0,0 +1,161 @@
+from langchain.docstore.document import Document
+from .chunking import count_tokens, html_to_text, looks_like_html
+from typing import List, Optional
+import asyncio
+import re
+import os
+
+# "hybrid" fuses vector and BM25 results, "dense" only uses the vectorstore
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")
+# Number of candidates fetched from each retriever before fusion
+RETRIEVAL_FETCH_K = int(os.getenv("RETRIEVAL_FETCH_K", "20"))
+# Rank constant of reciprocal rank fusion, higher values flatten the influence of top ranks
+RRF_K = int(os.getenv("RRF_K", "60"))
+# Maximum number of tokens of retrieved context put into the generation prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+
+
+def _doc_key(doc: Document):
+    return doc.metadata.get("doc_id") or doc.page_content
+
+
+def reciprocal_rank_fusion(result_lists: List[List[Document]], k: int, rrf_k: int = RRF_K) -> List[Document]:
+    scores = {}
+    documents = {}
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            key = _doc_key(doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+            documents.setdefault(key, doc)
+    ranking = sorted(scores, key=scores.get, reverse=True)
+    return [documents[key] for key in ranking[:k]]
+
+
+def _use_lexical(vectorstore):
+    return RETRIEVAL_MODE == "hybrid" and getattr(vectorstore, "lexical_index", None) is not None
+
+
+def search(vectorstore, query: str, query_embedding, k: int = 5, filter: Optional[dict] = None) -> List[Document]:
+    if not _use_lexical(vectorstore):
+        return vectorstore.similarity_search_by_vector(query_embedding, k=k, filter=filter)
+
+    dense = vectorstore.similarity_search_by_vector(query_embedding, k=RETRIEVAL_FETCH_K, filter=filter)
+    lexical = [doc for doc, _ in vectorstore.lexical_index.search(query, k=RETRIEVAL_FETCH_K, filter=filter)]
+    return reciprocal_rank_fusion([dense, lexical], k)
+
+
+async def asearch(vectorstore, query: str, query_embedding, k: int = 5, filter: Optional[dict] = None) -> List[Document]:
+    if not _use_lexical(vectorstore):
+        return await vectorstore.asimilarity_search_by_vector(query_embedding, k=k, filter=filter)
+
+    # The vector and the lexical search run concurrently
+    loop = asyncio.get_running_loop()
+    dense, lexical = await asyncio.gather(
+        vectorstore.asimilarity_search_by_vector(query_embedding, k=RETRIEVAL_FETCH_K, filter=filter),
+        loop.run_in_executor(None, vectorstore.lexical_index.search, query, RETRIEVAL_FETCH_K, filter),
+    )
+    return reciprocal_rank_fusion([dense, [doc for doc, _ in lexical]], k)
+
+
+def search_many(
+    vectorstore, queries: List[str], query_embeddings, k: int = 5, filter: Optional[dict] = None
+) -> List[List[Document]]:
+    """Search several queries with the same filter, the vector search runs as one collection query."""
+    n_results = RETRIEVAL_FETCH_K if _use_lexical(vectorstore) else k
+    results = vectorstore._collection.query(
+        query_embeddings=[list(embedding) for embedding in query_embeddings],
+        n_results=n_results,
+        where=filter,
+        include=["documents", "metadatas"],
+    )
+    dense = [
+        [Document(page_content=text, metadata=metadata or {}) for text, metadata in zip(texts, metadatas)]
+        for texts, metadatas in zip(results["documents"], results["metadatas"])
+    ]
+    if not _use_lexical(vectorstore):
+        return dense
+    return [
+        reciprocal_rank_fusion(
+            [docs, [doc for doc, _ in vectorstore.lexical_index.search(query, k=RETRIEVAL_FETCH_K, filter=filter)]], k
+        )
+        for query, docs in zip(queries, dense)
+    ]
+
+
+def _compact(text: str) -> str:
+    if looks_like_html(text):
+        text = html_to_text(text)
+    lines = (" ".join(line.split()) for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+
+def _merge_chunks(chunks: List[Document]) -> str:
+    # Consecutive chunks overlap, the shared text is only kept once
+    chunks = sorted(chunks, key=lambda doc: doc.metadata.get("chunk_index", 0))
+    prefix = re.compile(r"^Filename: .*?, Content: ", re.DOTALL)
+    merged = chunks[0].page_content
+    for chunk in chunks[1:]:
+        text = prefix.sub("", chunk.page_content, count=1)
+        overlap = next(
+            (size for size in range(min(len(merged), len(text), 1000), 0, -1) if merged.endswith(text[:size])),
+            0,
+        )
+        merged += ("" if overlap else " ... ") + text[overlap:]
+    return merged
+
+
+def assemble_context(documents: List[Document], token_budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    Format retrieved documents compactly for the generation prompt, within a token budget.
+
+    Duplicates are dropped, chunks of the same file are merged, and documents are grouped
+    with their retrieved parent (site, course, section, module) so related documents stay
+    together. Groups keep the rank of their best document. The last document that does
+    not fit into the budget is truncated, everything after it is left out.
+    """
+    # Merge chunks of the same file into one entry at the position of its best chunk
+    entries = {}
+    for doc in documents:
+        doc_id = doc.metadata.get("doc_id") or doc.page_content
+        key = doc_id.split("-chunk-")[0]
+        entries.setdefault(key, []).append(doc)
+
+    texts = {}
+    seen_texts = set()
+    for key, docs in entries.items():
+        text = _compact(_merge_chunks(docs) if len(docs) > 1 else docs[0].page_content)
+        if text in seen_texts:
+            continue
+        seen_texts.add(text)
+        texts[key] = (docs[0].metadata, text)
+
+    # Attach documents to a retrieved parent, so a module follows its section and so on
+    order = []
+    children = {}
+    for key, (metadata, _) in texts.items():
+        parent_id = metadata.get("parent_id")
+        if parent_id in texts and parent_id != key:
+            children.setdefault(parent_id, []).append(key)
+        else:
+            order.append(key)
+
+    def walk(key, depth):
+        yield key, depth
+        for child in children.get(key, []):
+            yield from walk(child, depth + 1)
+
+    parts = []
+    remaining = token_budget
+    for root in order:
+        for key, depth in walk(root, 0):
+            metadata, text = texts[key]
+            part = "  " * depth + f"[{metadata.get('doc_type', 'document')}] " + text
+            tokens = count_tokens(part)
+            if tokens > remaining:
+                if remaining > 32:
+                    # Cut proportionally, count_tokens is only used to find the cut
+                    parts.append(part[: int(len(part) * remaining / tokens)] + " ...")
+                return "\n\n".join(parts)
+            parts.append(part)
+            remaining -= tokens
+    return "\n\n".join(parts)
@@ -0,0 +1,169 @@
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from pydantic import BaseModel
+from typing import AsyncIterator, List, Optional
+from .main_router import (
+    Query,
+    get_vectorstore,
+    get_embedding,
+    get_answer_cache,
+    get_answer_chain,
+    get_context_router,
+    select_vectorstore,
+    get_answer_inputs,
+)
+from ..answer_cache import CachedAnswer
+from ..models.embeddings import embed_queries
+from ..retrieval import search_many
+from ..metrics import timed
+import logging
+import asyncio
+import json
+import os
+
+router = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of queries accepted by one batch request
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "1000"))
+# Answers generated concurrently for one batch, bounds the load a batch puts on the LLM server
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "8"))
+
+
+class BatchQuery(BaseModel):
+    queries: List[Query]
+
+
+class BatchResult(BaseModel):
+    index: int
+    response: Optional[str] = None
+    predicted_context: Optional[str] = None
+    cached: bool = False
+    error: Optional[str] = None
+
+
+async def abatch_chat(
+    queries: List[Query],
+    vectorstore,
+    embedding,
+    answer_chain,
+    context_router,
+    answer_cache=None,
+    concurrency: int = BATCH_LLM_CONCURRENCY,
+) -> AsyncIterator[BatchResult]:
+    """
+    Answer many queries and yield the results in the order they complete.
+
+    All queries are embedded in one batch, contexts are predicted up front and queries with
+    the same predicted context and course are searched with a single collection query.
+    Answers are generated by at most `concurrency` concurrent LLM calls.
+    """
+    loop = asyncio.get_running_loop()
+    with timed("batch_query_embedding"):
+        query_embeddings = await loop.run_in_executor(
+            None, embed_queries, embedding, [query.message for query in queries]
+        )
+
+    generation = answer_cache.generation if answer_cache is not None else None
+    pending = []
+    for index, (query, query_embedding) in enumerate(zip(queries, query_embeddings)):
+        cached = (
+            answer_cache.get(query_embedding, query.course_id, query.usercontext)
+            if answer_cache is not None
+            else None
+        )
+        if cached:
+            yield BatchResult(index=index, response=cached.answer, predicted_context=cached.predicted_context, cached=True)
+        else:
+            pending.append(index)
+
+    # Local predictions return at once, LLM fallbacks share the concurrency limit of the answers
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def predict(index):
+        async with semaphore:
+            return await context_router.apredict(queries[index], query_embeddings[index])
+
+    predictions = await asyncio.gather(*(predict(index) for index in pending), return_exceptions=True)
+
+    # Queries searching the same store with the same filter are searched together
+    groups = {}
+    for index, predicted_context in zip(pending, predictions):
+        if isinstance(predicted_context, Exception):
+            yield BatchResult(index=index, error=repr(predicted_context))
+            continue
+        store, search_kwargs = select_vectorstore(vectorstore, predicted_context, queries[index].course_id)
+        key = (id(store), repr(search_kwargs))
+        groups.setdefault(key, (store, search_kwargs, predicted_context, []))[3].append(index)
+
+    contexts = {}
+    failed = []
+    with timed("batch_vector_search"):
+        for store, search_kwargs, predicted_context, indices in groups.values():
+            try:
+                results = await loop.run_in_executor(
+                    None,
+                    lambda: search_many(
+                        store,
+                        [queries[index].message for index in indices],
+                        [query_embeddings[index] for index in indices],
+                        **search_kwargs,
+                    ),
+                )
+            except Exception as e:
+                logger.warning("Batch search for %s failed: %r", predicted_context, e)
+                failed.extend(
+                    BatchResult(index=index, predicted_context=predicted_context, error=repr(e)) for index in indices
+                )
+                continue
+            for index, context in zip(indices, results):
+                contexts[index] = (predicted_context, context)
+    for result in failed:
+        yield result
+
+    async def answer(index):
+        query = queries[index]
+        predicted_context, context = contexts[index]
+        try:
+            async with semaphore:
+                with timed("llm_total"):
+                    response = await answer_chain.ainvoke(get_answer_inputs(query, context))
+        except Exception as e:
+            logger.warning("Batch query %d failed: %r", index, e)
+            return BatchResult(index=index, predicted_context=predicted_context, error=repr(e))
+        if answer_cache is not None:
+            answer_cache.put(
+                query_embeddings[index],
+                query.course_id,
+                query.usercontext,
+                CachedAnswer(query.message, response, predicted_context),
+                generation,
+            )
+        return BatchResult(index=index, response=response, predicted_context=predicted_context)
+
+    for result in asyncio.as_completed([answer(index) for index in contexts]):
+        yield await result
+
+
+@router.post("/chat/batch")
+async def chat_batch(
+    batch: BatchQuery,
+    vectorstore=Depends(get_vectorstore),
+    embedding=Depends(get_embedding),
+    answer_cache=Depends(get_answer_cache),
+    answer_chain=Depends(get_answer_chain),
+    context_router=Depends(get_context_router),
+):
+    # Results are streamed as json lines as they complete, each line carries the index of its query
+    if len(batch.queries) > BATCH_MAX_QUERIES:
+        raise HTTPException(status_code=413, detail=f"At most {BATCH_MAX_QUERIES} queries per batch")
+
+    async def lines():
+        async for result in abatch_chat(
+            batch.queries, vectorstore, embedding, answer_chain, context_router, answer_cache
+        ):
+            yield json.dumps(jsonable_encoder(result)) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
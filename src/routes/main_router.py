@@ -1,18 +1,25 @@
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from fastapi import Response as FastAPIResponse
 from starlette.requests import Request
 from pydantic import BaseModel
-from typing import Optional
+from typing import Dict, Optional
 from langchain_core.prompts import ChatPromptTemplate
 from langchain.prompts import HumanMessagePromptTemplate
 from langchain_core.messages import SystemMessage
 from langchain_core.output_parsers import StrOutputParser
-from operator import itemgetter
-import os
-import re
-from ..models.utils import create_chat_openai_with_base
+from ..answer_cache import CachedAnswer
+from ..retrieval import search, asearch, assemble_context
+from ..models.embeddings import CachedQueryEmbeddings, MicroBatchingEmbeddings
+from ..metrics import timed, observe, render_metrics
+import logging
+import json
+import time
 
 router = APIRouter()
 
+logger = logging.getLogger(__name__)
+
 class Home(BaseModel):
     title: str = "MOODLE RAG CHAT API"
     description: str = "API for the MOODLE RAG CHAT project"
@@ -23,6 +30,19 @@ class Health(BaseModel):
     status: str
 
 
+class Readiness(BaseModel):
+    status: str
+    resources: Dict[str, bool]
+    error: Optional[str] = None
+
+
+class Stats(BaseModel):
+    query_embedding_cache: Optional[dict] = None
+    query_embedding_batching: Optional[dict] = None
+    answer_cache: Optional[dict] = None
+    context_router: Optional[dict] = None
+
+
 @router.get("/", response_model=Home)
 def index():
     return Home()
@@ -33,6 +53,55 @@ def health():
     return Health(status="ok")
 
 
+@router.get("/health/live", response_model=Health)
+def liveness():
+    return Health(status="ok")
+
+
+@router.get("/health/ready", response_model=Readiness)
+def readiness(req: Request, response: FastAPIResponse):
+    resources = req.app.state.RESOURCES
+    error = req.app.state.STARTUP_ERROR
+    if error:
+        status = "failed"
+    elif all(resources.values()):
+        status = "ready"
+    else:
+        status = "loading"
+    if status != "ready":
+        response.status_code = 503
+    return Readiness(status=status, resources=resources, error=error)
+
+
+@router.get("/stats", response_model=Stats)
+def stats(req: Request):
+    embedding = getattr(req.app.state, "EMBEDDINGFUNTION", None)
+    context_router = getattr(req.app.state, "CONTEXT_ROUTER", None)
+    cache = find_embedding_wrapper(embedding, CachedQueryEmbeddings)
+    batching = find_embedding_wrapper(embedding, MicroBatchingEmbeddings)
+    return Stats(
+        query_embedding_cache=cache.stats() if cache else None,
+        query_embedding_batching=batching.stats() if batching else None,
+        answer_cache=req.app.state.ANSWER_CACHE.stats(),
+        context_router=context_router.stats() if context_router else None,
+    )
+
+
+@router.get("/metrics")
+def metrics():
+    content, media_type = render_metrics()
+    return FastAPIResponse(content=content, media_type=media_type)
+
+
+def find_embedding_wrapper(embedding, wrapper_class):
+    # Embedding wrappers keep the wrapped embedding function in their embeddings attribute
+    while embedding is not None:
+        if isinstance(embedding, wrapper_class):
+            return embedding
+        embedding = vars(embedding).get("embeddings")
+    return None
+
+
 class Query(BaseModel):
     message: str
     course_id: Optional[str] = None
@@ -43,18 +112,144 @@ class Response(BaseModel):
     response: str
 
 
+ANSWER_PROMPT = ChatPromptTemplate.from_messages(
+    [
+        SystemMessage(
+            content=(
+                "Du bist ein hilfreicher Assistent der dabei unterstützt, passende Kurse auf der Kursplattform FututreLearnLab zu finden und über die verfügbaren Lerninhalte zu informieren."
+            )
+        ),
+        HumanMessagePromptTemplate.from_template(
+            (   
+                "Nutze den folgenden Kontext, um die nachfolgende Nutzeranfrage zu beantworten\n"
+                "\n"
+                "Der Nutzer befindet sich momentan auf der Kursplatform in folgendem Kontext: {usercontext}\n"
+                "Bei Fragen zu bestimmten Kursinhalten oder verfügbaren Kursen, nutze auschließlich Infromationen aus dem nachgehenden Kontext, der auf Basis der Nutzeranfrage zusammengestellt wurde. Nicht alle Informationen sind relevant, entscheide also selbst, welche Informationen du teilen möchtest.\n"
+                "{context}\n"
+                "\n"
+                "Kontext Ende"
+                "\n"
+                "Der Nutzer hat folgende Nachricht geschrieben: {query}"
+                "\n"
+                "Antworte auf die Nutzeranfrage unter Berücksichtigung des Kontexts und der Nutzeranfrage. Wenn der Kontext keine relevanten Informationen enthält, antworte mit 'Ich habe keine Informationen zu diesem Thema'."
+            )
+        ),
+    ]
+)
+
+
+# Chains are built once at startup and stored in the app state, see src/app.py
+def create_answer_chain(model):
+    return ANSWER_PROMPT | model | StrOutputParser()
+
+
+def get_loaded_resource(req: Request, name: str):
+    # Resources are loaded in the background after startup, see src/app.py
+    resource = getattr(req.app.state, name, None)
+    if resource is None:
+        raise HTTPException(status_code=503, detail="Service is starting, please retry shortly")
+    return resource
+
+
 def get_vectorstore(req: Request):
-    return req.app.state.VECTORSTORE
+    return get_loaded_resource(req, "VECTORSTORE")
 
 
-@router.post("/chat", response_model=Response)
-def chat(request: Query, vectorstore=Depends(get_vectorstore)):
-    predicted_context = predict_context(request)
-    response = process_query(request, vectorstore, predicted_context)
-    return Response(response=response)
+def get_answer_chain(req: Request):
+    return req.app.state.ANSWER_CHAIN
+
+
+def get_context_router(req: Request):
+    return get_loaded_resource(req, "CONTEXT_ROUTER")
+
 
+def get_embedding(req: Request):
+    return get_loaded_resource(req, "EMBEDDINGFUNTION")
 
-def process_query(request, vectorstore, predicted_context):
+
+def get_answer_cache(req: Request):
+    return req.app.state.ANSWER_CACHE
+
+
+@router.post("/chat", response_model=Response)
+async def chat(
+    request: Query,
+    vectorstore=Depends(get_vectorstore),
+    embedding=Depends(get_embedding),
+    answer_cache=Depends(get_answer_cache),
+    answer_chain=Depends(get_answer_chain),
+    context_router=Depends(get_context_router),
+):
+    with timed("total"):
+        # The query is embedded once, for the answer cache lookup, context routing and retrieval
+        with timed("query_embedding"):
+            query_embedding = await embedding.aembed_query(request.message)
+        generation = answer_cache.generation
+        cached = answer_cache.get(query_embedding, request.course_id, request.usercontext)
+        if cached:
+            logger.debug("Answer cache hit for query: %s", cached.query)
+            return Response(response=cached.answer)
+
+        predicted_context, context = await aroute_and_retrieve(
+            request, vectorstore, context_router, query_embedding
+        )
+        # Streamed internally, so the time to the first token is measured for /chat as well
+        tokens = [token async for token in astream_answer(answer_chain, get_answer_inputs(request, context))]
+        response = "".join(tokens)
+        answer_cache.put(
+            query_embedding,
+            request.course_id,
+            request.usercontext,
+            CachedAnswer(request.message, response, predicted_context),
+            generation,
+        )
+        return Response(response=response)
+
+
+@router.post("/chat/stream")
+async def chat_stream(
+    request: Query,
+    vectorstore=Depends(get_vectorstore),
+    embedding=Depends(get_embedding),
+    answer_cache=Depends(get_answer_cache),
+    answer_chain=Depends(get_answer_chain),
+    context_router=Depends(get_context_router),
+):
+    # Server-sent events, every event carries a json encoded chunk of the answer
+    async def event_stream():
+        start = time.perf_counter()
+        with timed("query_embedding"):
+            query_embedding = await embedding.aembed_query(request.message)
+        generation = answer_cache.generation
+        cached = answer_cache.get(query_embedding, request.course_id, request.usercontext)
+        if cached:
+            yield f"data: {json.dumps({'token': cached.answer})}\n\n"
+            yield "data: [DONE]\n\n"
+            observe("total", time.perf_counter() - start)
+            return
+
+        predicted_context, context = await aroute_and_retrieve(
+            request, vectorstore, context_router, query_embedding
+        )
+        tokens = []
+        async for token in astream_answer(answer_chain, get_answer_inputs(request, context)):
+            tokens.append(token)
+            yield f"data: {json.dumps({'token': token})}\n\n"
+        yield "data: [DONE]\n\n"
+        observe("total", time.perf_counter() - start)
+
+        answer_cache.put(
+            query_embedding,
+            request.course_id,
+            request.usercontext,
+            CachedAnswer(request.message, "".join(tokens), predicted_context),
+            generation,
+        )
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
+
+def get_search_kwargs(predicted_context, course_id, in_course_partition=False):
     # Retriever will search for the top_5 most similar documents to the query.
     search_kwargs={"k": 5}
     filters = []
@@ -63,9 +258,12 @@ def process_query(request, vectorstore, predicted_context):
         # Define a mapping of predicted_context to their respective filter functions
         context_filters = {
             "Site-Context": lambda: [{"doc_type": {"$in": ["site", "course"]}}],
-            "Course-Context": lambda: [
-                {"course_id": {"$eq": course_id}, "doc_type": {"$in": ["course", "module"]}}
-            ] if course_id else []
+            # Chroma only accepts a single field per filter clause, several clauses are combined with $and.
+            # A course partition only holds the documents of its course, so it needs no course filter.
+            "Course-Context": lambda: (
+                ([] if in_course_partition else [{"course_id": {"$eq": course_id}}])
+                + [{"doc_type": {"$in": ["course", "module", "content"]}}]
+            ) if course_id else []
         }
 
         # Get the filter function based on predicted_context, default to an empty list if context not found
@@ -74,137 +272,80 @@ def process_query(request, vectorstore, predicted_context):
         return filters
 
     # Usage in your main_router.py
-    filters = get_filters_for_context(predicted_context, request.course_id)
+    filters = get_filters_for_context(predicted_context, course_id)
 
     if filters:
         search_kwargs["filter"] = {"$and": filters} if len(filters) > 1 else filters[0]
     
-    print("Set retriever with filters: " + str(search_kwargs))
+    logger.debug("Set retriever with filters: %s", search_kwargs)
     
-    retriever = vectorstore.as_retriever(search_kwargs=search_kwargs)
-
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            SystemMessage(
-                content=(
-                    "Du bist ein hilfreicher Assistent der dabei unterstützt, passende Kurse auf der Kursplattform FututreLearnLab zu finden und über die verfügbaren Lerninhalte zu informieren."
-                )
-            ),
-            HumanMessagePromptTemplate.from_template(
-                (   
-                    "Nutze den folgenden Kontext, um die nachfolgende Nutzeranfrage zu beantworten\n"
-                    "\n"
-                    "Der Nutzer befindet sich momentan auf der Kursplatform in folgendem Kontext: {usercontext}\n"
-                    "Bei Fragen zu bestimmten Kursinhalten oder verfügbaren Kursen, nutze auschließlich Infromationen aus dem nachgehenden Kontext, der auf Basis der Nutzeranfrage zusammengestellt wurde. Nicht alle Informationen sind relevant, entscheide also selbst, welche Informationen du teilen möchtest.\n"
-                    "{context}\n"
-                    "\n"
-                    "Kontext Ende"
-                    "\n"
-                    "Der Nutzer hat folgende Nachricht geschrieben: {query}"
-                    "\n"
-                    "Antworte auf die Nutzeranfrage unter Berücksichtigung des Kontexts und der Nutzeranfrage. Wenn der Kontext keine relevanten Informationen enthält, antworte mit 'Ich habe keine Informationen zu diesem Thema'."
-                )
-            ),
-        ]
+    return search_kwargs
+
+
+def select_vectorstore(vectorstore, predicted_context, course_id):
+    partitions = getattr(vectorstore, "partitions", None)
+    partition = partitions.select(predicted_context, course_id) if partitions is not None else None
+    if partition is None:
+        return vectorstore, get_search_kwargs(predicted_context, course_id)
+    # The lexical index of a partition adds the partition's own filter, see PartitionLexicalIndex
+    logger.debug("Searching partition %s", partition._collection.name)
+    return partition, get_search_kwargs(
+        predicted_context, course_id, in_course_partition=predicted_context == "Course-Context"
     )
-    
-    # model = create_chat_openai_with_base(os.getenv("DEFAULT_CUSTOM_LLM_URL"))
-    model = create_chat_openai_with_base(os.getenv("DEFAULT_CUSTOM_LLM_URL"), openai_api_key="lm-studio")
-
-    chain = (
-        {"context": itemgetter("query") | retriever, "query": itemgetter("query"), "usercontext" : itemgetter("usercontext")}
-        | prompt
-        | model
-        | StrOutputParser()
-    )
-
-    print("Retrieving context")
-    context = retriever.invoke(request.message)
-    print("Context retrieved")
-
-    print("Context: " + str(context))
-
-    print("Processing query")
-    print(prompt.format_prompt(query = request.message, usercontext = request.usercontext, context = context))
-
-    return chain.invoke({"query": request.message, "usercontext": request.usercontext})
-
-def predict_context(request):
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            HumanMessagePromptTemplate.from_template(
-                (   
-                    "User Query: {query}\n"
-                    "User Context: {usercontext}\n"
-                    "\n"
-                    "Based on the previous query choose which sources are most relevant to answer the user query.\n"
-                    "\n"
-                    "Choose one of the following options, by reffering to its name only:\n"
-                    "[Site-Context]: Includes general information about the site, its features and course offerings.\n"
-                    "[Course-Context]: Includes information about a single specific course and its contents.\n"
-                    "[User-Context]: Includes information about the current user, its bio, learning activity and interests and goals."
-                )
-            ),
-        ]
-    )
-    
-    # model = create_chat_openai_with_base(os.getenv("DEFAULT_CUSTOM_LLM_URL"))
-    model = create_chat_openai_with_base(os.getenv("MINI_CUSTOM_LLM_URL"), openai_api_key="lm-studio", max_tokens=128)
 
-    chain = ( prompt | model | StrOutputParser() )
-
-    print("Processing query")
-    print(prompt.format_prompt(query = request.message, usercontext = request.usercontext))
-
-    answer = chain.invoke({"query": request.message, "usercontext": request.usercontext})
-    print("Answer: " + str(answer))
-    # get only content that matches the desired output [Site-Context] or [Course-Context] or [User-Context]
-
-    match = re.search(r"\[(.*?)\]", answer)
-    if match:
-        predicted_context = match.group(1)
-    else:
-        return None
 
-    print("Predicted context: " + str(predicted_context))
+def retrieve_context(vectorstore, query, query_embedding, predicted_context, course_id):
+    vectorstore, search_kwargs = select_vectorstore(vectorstore, predicted_context, course_id)
+    with timed("vector_search"):
+        return search(vectorstore, query, query_embedding, **search_kwargs)
 
-    return predicted_context
 
+async def aretrieve_context(vectorstore, query, query_embedding, predicted_context, course_id):
+    vectorstore, search_kwargs = select_vectorstore(vectorstore, predicted_context, course_id)
+    with timed("vector_search"):
+        return await asearch(vectorstore, query, query_embedding, **search_kwargs)
 
-# Query example for preselectioon relevant context for user query:
 
-# Example 1:
+async def aroute_and_retrieve(request, vectorstore, context_router, query_embedding):
+    async def retrieve(predicted_context):
+        return await aretrieve_context(vectorstore, request.message, query_embedding, predicted_context, request.course_id)
 
-# User Query: Welche Kurse kann ich auf dieser Plattform belegen?
-# User Context: The user visits the site as a guest. The user currently views the homepage of the site.
+    return await context_router.aroute(request, query_embedding, retrieve)
 
-# Based on the previous query choose which sources are most relevant to answer the user query.
 
-# Choose one of the following options, by reffering to its name only:
-# [Site-Context]: Includes general information about the site, its features and course offerings.
-# [Course-Context]: Includes information about a single specific course and its contents.
-# [User-Context]: Includes information about the current user.
+async def astream_answer(answer_chain, inputs):
+    # Yields the answer tokens, recording the time to the first token and the total generation time
+    start = time.perf_counter()
+    first_token = True
+    async for token in answer_chain.astream(inputs):
+        if first_token:
+            observe("llm_first_token", time.perf_counter() - start)
+            first_token = False
+        yield token
+    observe("llm_total", time.perf_counter() - start)
 
-# Example 2:
 
-# User Query: Fasse das Feedback zum Kurs zusammen,
-# User Context: The user is logged in as a teacher. The user currently views the course overview.
+def get_answer_inputs(request, context):
+    # The context is retrieved once, formatted within the token budget and passed into the answer chain
+    with timed("prompt_assembly"):
+        inputs = {"context": assemble_context(context), "query": request.message, "usercontext": request.usercontext}
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Context: %s", context)
+        logger.debug("Prompt: %s", ANSWER_PROMPT.format_prompt(**inputs))
+    return inputs
 
-# Based on the previous query choose which sources are most relevant to answer the user query.
 
-# Choose one of the following options, by reffering to its name only:
-# [Site-Context]: Includes general information about the site, its features and course offerings.
-# [Course-Context]: Includes information about a single specific course and its contents.
-# [User-Context]: Includes information about the current user, its bio, learning activity and interests and goals.
+def process_query(request, vectorstore, predicted_context, answer_chain, query_embedding=None):
+    if query_embedding is None:
+        query_embedding = vectorstore.embeddings.embed_query(request.message)
 
-# Example 3:
+    context = retrieve_context(vectorstore, request.message, query_embedding, predicted_context, request.course_id)
+    return answer_chain.invoke(get_answer_inputs(request, context))
 
-# User Query: Welche Kurse habe ich bereits abgeschlossen?
-# User Context: The user is logged in as a student. The user currently views the dashboard.
 
-# Based on the previous query choose which sources are most relevant to answer the user query.
+async def aprocess_query(request, vectorstore, predicted_context, answer_chain, query_embedding=None):
+    if query_embedding is None:
+        query_embedding = await vectorstore.embeddings.aembed_query(request.message)
 
-# Choose one of the following options, by reffering to its name only:
-# [Site-Context]: Includes general information about the site, its features and course offerings.
-# [Course-Context]: Includes information about a single specific course and its contents.
-# [User-Context]: Includes information about the current user, its bio, learning activity and interests and goals.
\ No newline at end of file
+    context = await aretrieve_context(vectorstore, request.message, query_embedding, predicted_context, request.course_id)
+    return await answer_chain.ainvoke(get_answer_inputs(request, context))
\ No newline at end of file
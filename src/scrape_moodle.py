@@ -1,9 +1,97 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 from pydantic import BaseModel, Field
-from typing import Tuple, List, Optional
+from typing import Iterator, Tuple, List, Optional
+from .metrics import timed_pipeline
+from .file_contents import (
+    FileTextCache,
+    extract_text,
+    get_file_kind,
+    FILE_FETCH_CONCURRENCY,
+    FILE_MAX_BYTES,
+    FILE_CHUNK_SIZE,
+)
+import threading
+import json
+import time
 import os
 
 
+# Crawler configuration
+CRAWL_CONCURRENCY = int(os.getenv("MOODLE_CRAWL_CONCURRENCY", "8"))
+# Maximum number of requests per second sent to a single host, 0 disables the limit
+CRAWL_RATE_LIMIT = float(os.getenv("MOODLE_CRAWL_RATE_LIMIT", "10"))
+CRAWL_MAX_RETRIES = int(os.getenv("MOODLE_CRAWL_MAX_RETRIES", "3"))
+CRAWL_TIMEOUT = float(os.getenv("MOODLE_CRAWL_TIMEOUT", "60"))
+CRAWL_MANIFEST_PATH = os.getenv(
+    "MOODLE_CRAWL_MANIFEST", os.path.join("data", "crawl", "manifest.json")
+)
+# Courses are refetched after this many days even if their timemodified did not change,
+# since editing a module does not always bump the course's timemodified.
+CRAWL_MAX_AGE_DAYS = float(os.getenv("MOODLE_CRAWL_MAX_AGE_DAYS", "7"))
+
+
+class HostRateLimiter:
+    """Spaces out requests so that each host receives at most `rate` requests per second."""
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+_session = None
+_session_lock = threading.Lock()
+_rate_limiter = HostRateLimiter(CRAWL_RATE_LIMIT)
+
+
+def get_session() -> requests.Session:
+    # One pooled session is shared by all crawler threads so connections are kept alive.
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=CRAWL_MAX_RETRIES,
+                backoff_factor=0.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET"],
+                respect_retry_after_header=True,
+            )
+            adapter = HTTPAdapter(
+                pool_connections=4,
+                # Course contents and file downloads are fetched by separate pools on the same session
+                pool_maxsize=max(CRAWL_CONCURRENCY, 1) + max(FILE_FETCH_CONCURRENCY, 1),
+                max_retries=retry,
+            )
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session = session
+        return _session
+
+
+def http_get(url, params, stream=False):
+    _rate_limiter.wait(url)
+    response = get_session().get(url, params=params, timeout=CRAWL_TIMEOUT, stream=stream)
+    response.raise_for_status()
+    return response
+
+
 # Function to call Moodle API
 def moodle_api_call(function_name, params):
     # Configuration
@@ -13,18 +101,22 @@ def moodle_api_call(function_name, params):
     params["wstoken"] = API_TOKEN
     params["moodlewsrestformat"] = "json"
     params["wsfunction"] = function_name
-    response = requests.get(REST_ENDPOINT, params=params)
-    response.raise_for_status()
+    response = http_get(REST_ENDPOINT, params)
     return response.json()
 
 
-def get_content_text(fileurl):
+def get_content_text(fileurl, filename, mimetype=None) -> Optional[str]:
+    kind = get_file_kind(filename, mimetype)
+    if kind is None:
+        return None
     API_TOKEN = os.getenv("MOODLE_API_TOKEN")
     params = {}
     params["wstoken"] = API_TOKEN
-    response = requests.get(fileurl, params=params)
-    response.raise_for_status()
-    return response.json()
+    # The file is streamed into the text extraction, it is never held in memory as a whole
+    with http_get(fileurl, params, stream=True) as response:
+        # requests falls back to latin-1 for text without a charset, Moodle serves utf-8
+        encoding = response.encoding if "charset" in response.headers.get("Content-Type", "") else "utf-8"
+        return extract_text(kind, response.iter_content(FILE_CHUNK_SIZE), encoding)
 
 
 class MoodleModuleContent:
@@ -32,14 +124,25 @@ class MoodleModuleContent:
         self,
         type: str,
         course_id: int = None,
+        module_id: int = None,
         filename: Optional[str] = "",
         fileurl: Optional[str] = "",
         text: Optional[str] = "",
+        timemodified: Optional[int] = None,
+        filepath: Optional[str] = "/",
+        mimetype: Optional[str] = None,
+        filesize: Optional[int] = None,
     ):
         self.type = type
+        self.course_id = course_id
+        self.module_id = module_id
+        self.timemodified = timemodified
         self.filename = filename
+        self.filepath = filepath
         self.fileurl = fileurl
         self.text = text
+        self.mimetype = mimetype
+        self.filesize = filesize
 
     def __str__(self):
         string = f"Filename: {self.filename}"
@@ -47,11 +150,16 @@ class MoodleModuleContent:
             string += f", Content: {self.text}"
         return string
 
+    def doc_id(self):
+        # Folders can hold the same filename in several directories, files in the root keep their plain id
+        return f"content-{self.module_id}-{(self.filepath or '/').lstrip('/')}{self.filename}"
+
     def asdict(self):
         return {
             "filename": self.filename,
             "doc_type": "content",
-            "course_id": self.course_id,
+            "course_id": str(self.course_id),
+            "parent_id": f"module-{self.module_id}",
         }
 
 
@@ -61,10 +169,15 @@ class MoodleModule:
         name: str,
         modname: str,
         url: str,
+        id: int = None,
         course_id: int = None,
+        section_id: int = None,
         description: Optional[str] = "",
         contents: List[MoodleModuleContent] = [],
     ):
+        self.id = id
+        self.course_id = course_id
+        self.section_id = section_id
         self.name = name
         self.description = description
         self.modname = modname
@@ -80,17 +193,22 @@ class MoodleModule:
         """
         if len(self.contents) == 0:
             return string
+        # Only the filenames are listed, the file texts are indexed as separate content documents
         string += "\nContents:"
         for content in self.contents:
-            string += "\n - " + str(content)
+            string += "\n - " + str(content.filename)
         return string
 
+    def doc_id(self):
+        return f"module-{self.id}"
+
     def asdict(self):
         return {
             "name": self.name,
             "description": self.description,
             "doc_type": "module",
-            "course_id": self.course_id,
+            "course_id": str(self.course_id),
+            "parent_id": f"section-{self.section_id}",
         }
 
 
@@ -98,10 +216,13 @@ class MoodleCourseSection:
     def __init__(
         self,
         name: str,
+        id: int = None,
         course_id: int = None,
         description: Optional[str] = "",
         modules: List[MoodleModule] = [],
     ):
+        self.id = id
+        self.course_id = course_id
         self.name = name
         self.description = description
         self.modules = modules
@@ -120,12 +241,16 @@ class MoodleCourseSection:
             )
         return string
 
+    def doc_id(self):
+        return f"section-{self.id}"
+
     def asdict(self):
         return {
             "name": self.name,
             "description": self.description,
             "doc_type": "section",
-            "course_id": self.course_id,
+            "course_id": str(self.course_id),
+            "parent_id": f"course-{self.course_id}",
         }
 
 
@@ -136,10 +261,12 @@ class MoodleCourse:
         name: str,
         summary: Optional[str] = "",
         sections: List[MoodleCourseSection] = [],
+        timemodified: Optional[int] = None,
     ):
         self.id = id
         self.name = name
         self.summary = summary
+        self.timemodified = timemodified
         self.url = f"{os.getenv('MOODLE_URL')}/course/view.php?id={id}"
         self.sections = sections
 
@@ -156,6 +283,9 @@ class MoodleCourse:
             string += "\n - " + section.name
         return string
 
+    def doc_id(self):
+        return f"course-{self.id}"
+
     def asdict(self):
         return {
             "course_id": str(self.id),
@@ -163,6 +293,7 @@ class MoodleCourse:
             "summary": self.summary,
             "url": self.url,
             "doc_type": "course",
+            "parent_id": "site",
         }
 
 
@@ -200,6 +331,9 @@ class MoodleSiteInfo:
 
         return string
 
+    def doc_id(self):
+        return "site"
+
     def asdict(self):
         return {
             "name": self.name,
@@ -209,6 +343,57 @@ class MoodleSiteInfo:
         }
 
 
+class CrawlManifest:
+    """
+    Remembers what was fetched during the last crawl, so unchanged courses can be skipped.
+
+    Courses are keyed by id and store their timemodified together with the raw
+    core_course_get_contents response. Only entries seen during the current crawl
+    are written back, so removed courses are pruned automatically. File texts are
+    kept on disk by the FileTextCache instead.
+    """
+
+    def __init__(self, path: str = CRAWL_MANIFEST_PATH):
+        self.path = path
+        self.previous = {"courses": {}}
+        self.current = {"courses": {}}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.previous = json.load(f)
+
+    def get_course_contents(self, course_id, timemodified):
+        entry = self.previous["courses"].get(str(course_id))
+        if not entry or timemodified is None:
+            return None
+        if entry.get("timemodified") != timemodified:
+            return None
+        if time.time() - entry.get("crawled_at", 0) > CRAWL_MAX_AGE_DAYS * 86400:
+            return None
+        with self._lock:
+            self.current["courses"][str(course_id)] = entry
+        return entry["contents"]
+
+    def update_course(self, course_id, timemodified, contents):
+        with self._lock:
+            self.current["courses"][str(course_id)] = {
+                "timemodified": timemodified,
+                "crawled_at": time.time(),
+                "contents": contents,
+            }
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first so an interrupted crawl never leaves a corrupt manifest
+        tmp_path = self.path + ".tmp"
+        with self._lock:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.current, f)
+        os.replace(tmp_path, self.path)
+
+
 # Get list of courses
 def get_courses() -> MoodleSiteInfo:
     function_name = "core_course_get_courses"
@@ -217,7 +402,7 @@ def get_courses() -> MoodleSiteInfo:
 
     # First course is the site info
     if len(data) == 0:
-        return None, []
+        return None
 
     site_info = MoodleSiteInfo(
         name=data[0].get("fullname"),
@@ -226,13 +411,14 @@ def get_courses() -> MoodleSiteInfo:
     )
 
     if len(data) < 2:
-        return site_info, []
+        return site_info
 
     courses = [
         MoodleCourse(
             id=course.get("id"),
             name=course.get("fullname"),
             summary=course.get("summary"),
+            timemodified=course.get("timemodified"),
         )
         for course in data[1:]
     ]
@@ -242,11 +428,62 @@ def get_courses() -> MoodleSiteInfo:
     return site_info
 
 
+def fetch_content_text(content: "MoodleModuleContent", cache: Optional[FileTextCache] = None):
+    if cache is not None:
+        text = cache.get(content.fileurl, content.timemodified)
+        if text is not None:
+            return text
+    with timed_pipeline("fetch_file"):
+        text = get_content_text(content.fileurl, content.filename, content.mimetype)
+    # Files whose text could not be extracted are retried on the next crawl
+    if cache is not None and text is not None:
+        cache.put(content.fileurl, content.timemodified, text)
+    return text
+
+
+def fetch_content_texts(
+    contents: List["MoodleModuleContent"],
+    cache: Optional[FileTextCache] = None,
+    executor: Optional[ThreadPoolExecutor] = None,
+):
+    """Fill in the texts of the files that have extractable text, downloading them on the executor."""
+    fetchable = []
+    for content in contents:
+        if not content.fileurl or get_file_kind(content.filename, content.mimetype) is None:
+            continue
+        if content.filesize and content.filesize > FILE_MAX_BYTES:
+            print(f"Skipping {content.filename}, {content.filesize} bytes exceed the file size limit")
+            continue
+        fetchable.append(content)
+
+    if executor is None:
+        results = [(content, None) for content in fetchable]
+    else:
+        results = [(content, executor.submit(fetch_content_text, content, cache)) for content in fetchable]
+
+    for content, future in results:
+        try:
+            text = future.result() if future else fetch_content_text(content, cache)
+        except Exception as e:
+            # A file that can not be read is indexed by its filename, it does not fail the crawl
+            print(f"Could not read the text of {content.filename}: {e!r}")
+            continue
+        content.text = text or ""
+
+
 # Get course sections
-def get_course_sections(course_id) -> List[MoodleCourseSection]:
-    function_name = "core_course_get_contents"
-    params = {"courseid": course_id}
-    data = moodle_api_call(function_name, params)
+def get_course_sections(
+    course_id, timemodified=None, manifest: Optional[CrawlManifest] = None
+) -> List[MoodleCourseSection]:
+    data = None
+    if manifest:
+        data = manifest.get_course_contents(course_id, timemodified)
+    if data is None:
+        function_name = "core_course_get_contents"
+        params = {"courseid": course_id}
+        data = moodle_api_call(function_name, params)
+        if manifest:
+            manifest.update_course(course_id, timemodified, data)
     sections = []
     for section in data:
         modules = []
@@ -254,28 +491,25 @@ def get_course_sections(course_id) -> List[MoodleCourseSection]:
             contents = []
             if "contents" in module:
                 for content in module.get("contents"):
-                    if (
-                        content.get("type") == "file"
-                        and content.get("filename")
-                        and content.get("filename").endswith(".html")
-                    ):
-                        contenttext = get_content_text(content.get("fileurl"))
-                        contents.append(
-                            MoodleModuleContent(
-                                type="file",
-                                filename=content.get("filename"),
-                                fileurl=content.get("fileurl"),
-                                text=contenttext,
-                            )
-                        )
-                    else:
-                        contents.append(
-                            MoodleModuleContent(
-                                type="file", filename=content.get("filename")
-                            )
+                    # File texts are fetched in a separate stage, see fetch_content_texts
+                    contents.append(
+                        MoodleModuleContent(
+                            type="file",
+                            course_id=course_id,
+                            module_id=module.get("id"),
+                            filename=content.get("filename"),
+                            filepath=content.get("filepath"),
+                            fileurl=content.get("fileurl") if content.get("type") == "file" else "",
+                            timemodified=content.get("timemodified"),
+                            mimetype=content.get("mimetype"),
+                            filesize=content.get("filesize"),
                         )
+                    )
             modules.append(
                 MoodleModule(
+                    id=module.get("id"),
+                    course_id=course_id,
+                    section_id=section.get("id"),
                     name=module.get("name"),
                     modname=module.get("modname"),
                     url=module.get("url"),
@@ -284,6 +518,8 @@ def get_course_sections(course_id) -> List[MoodleCourseSection]:
             )
         sections.append(
             MoodleCourseSection(
+                id=section.get("id"),
+                course_id=course_id,
                 name=section.get("name"),
                 description=section.get("summary"),
                 modules=modules,
@@ -293,13 +529,110 @@ def get_course_sections(course_id) -> List[MoodleCourseSection]:
     return sections
 
 
-# Main function to scrape data
-def scrape_moodle_data() -> MoodleSiteInfo:
-    MOODLE_URL = (os.getenv("MOODLE_URL"),)
-    site = get_courses()
+def crawl_courses(
+    site: MoodleSiteInfo,
+    concurrency: int,
+    manifest: Optional[CrawlManifest] = None,
+    cache: Optional[FileTextCache] = None,
+) -> Iterator[MoodleCourse]:
+    """Fill in the sections of each course and yield the courses in order as they are done."""
+    # File downloads run on their own pool, so a course with many files does not hold up the others.
+    # A concurrency of 1 crawls everything sequentially, file downloads included.
+    file_executor = (
+        ThreadPoolExecutor(max_workers=FILE_FETCH_CONCURRENCY)
+        if concurrency > 1 and FILE_FETCH_CONCURRENCY > 1
+        else None
+    )
 
-    for course in site.courses:
-        sections = get_course_sections(course.id)
-        course.sections = sections
+    def crawl_course(course):
+        with timed_pipeline("crawl_course"):
+            sections = get_course_sections(course.id, course.timemodified, manifest)
+            contents = [content for section in sections for module in section.modules for content in module.contents]
+            fetch_content_texts(contents, cache, file_executor)
+            return sections
+
+    try:
+        if concurrency <= 1:
+            for course in site.courses:
+                course.sections = crawl_course(course)
+                yield course
+            return
+
+        # Fetch course contents concurrently, the shared session and rate limiter keep the load on Moodle bounded.
+        # Only a window of courses is in flight, so finished courses do not pile up in memory.
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            pending = deque()
+            for course in site.courses:
+                if len(pending) >= concurrency * 2:
+                    done_course, future = pending.popleft()
+                    done_course.sections = future.result()
+                    yield done_course
+                pending.append((course, executor.submit(crawl_course, course)))
+            while pending:
+                done_course, future = pending.popleft()
+                done_course.sections = future.result()
+                yield done_course
+    finally:
+        if file_executor is not None:
+            file_executor.shutdown(wait=True, cancel_futures=True)
+
+
+def iter_course_objects(course: MoodleCourse):
+    yield course
+    for section in course.sections:
+        yield section
+        for module in section.modules:
+            yield module
+            for content in module.contents:
+                yield content
+
+
+def get_file_text_cache() -> FileTextCache:
+    cache = FileTextCache()
+    cache.prune()
+    return cache
+
+
+# Main function to scrape data
+def scrape_moodle_data(
+    concurrency: Optional[int] = None, incremental: bool = True
+) -> MoodleSiteInfo:
+    if concurrency is None:
+        concurrency = CRAWL_CONCURRENCY
+    manifest = CrawlManifest() if incremental else None
+    cache = get_file_text_cache() if incremental else None
+    with timed_pipeline("crawl_courses_list"):
+        site = get_courses()
+
+    for course in crawl_courses(site, concurrency, manifest, cache):
+        pass
+
+    if manifest:
+        manifest.save()
 
     return site
+
+
+def stream_moodle_data(concurrency: Optional[int] = None, incremental: bool = True):
+    """
+    Crawl Moodle and yield the site, courses, sections, modules and contents one course at a time.
+
+    The sections of a course are released once its objects have been yielded, so peak memory
+    is bounded by the courses in flight rather than the whole site.
+    """
+    if concurrency is None:
+        concurrency = CRAWL_CONCURRENCY
+    manifest = CrawlManifest() if incremental else None
+    cache = get_file_text_cache() if incremental else None
+    with timed_pipeline("crawl_courses_list"):
+        site = get_courses()
+    if site is None:
+        return
+
+    yield site
+    for course in crawl_courses(site, concurrency, manifest, cache):
+        yield from iter_course_objects(course)
+        course.sections = []
+
+    if manifest:
+        manifest.save()
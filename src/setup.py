@@ -1,67 +1,653 @@
 from langchain_community.vectorstores import Chroma
 from chromadb.config import Settings
 from chromadb import PersistentClient
+from chromadb.api.shared_system_client import SharedSystemClient
 from langchain_community.embeddings import HuggingFaceInstructEmbeddings
 from langchain.docstore.document import Document
-from .scrape_moodle import scrape_moodle_data, MoodleSiteInfo
+from .lexical_index import LexicalIndex
+from .partitions import VectorStorePartitions, PARTITIONS_ENABLED, SITE_PARTITION
+from .models.embeddings import (
+    CachedQueryEmbeddings,
+    MicroBatchingEmbeddings,
+    OnnxInstructorEmbeddings,
+    quantize_torch_embeddings,
+    DocumentEmbeddingCache,
+    DOCUMENT_EMBEDDING_CACHE_PATH,
+    QUERY_EMBEDDING_CACHE_SIZE,
+    QUERY_BATCH_MAX_WAIT_MS,
+)
+from .scrape_moodle import (
+    stream_moodle_data,
+    iter_course_objects,
+    MoodleModuleContent,
+    MoodleSiteInfo,
+)
+from .chunking import CHUNKING_ENABLED, html_to_text, looks_like_html, split_text
+from .metrics import timed_pipeline
+from .crawl_snapshot import CRAWL_SNAPSHOT_ENABLED, read_snapshot, write_snapshot
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from collections import Counter
+from contextlib import contextmanager
+from itertools import islice
+from typing import Iterable, List
+import multiprocessing
+import threading
+import hashlib
+import weakref
+import shutil
+import json
+import time
 import os
 
+try:
+    import fcntl
+except ImportError:
+    # Windows has no flock, open stores are then only tracked within the current process
+    fcntl = None
 
-def load_embedding_function():
-    return HuggingFaceInstructEmbeddings(
-        model_name="hkunlp/instructor-large",
-        query_instruction="Represent the user query for retriving relevant documents: ",
-        embed_instruction="Represent the document for retrieval: ",
-    )
 
+STORES_DIRECTORY = os.path.join("data", "stores")
+PERSIST_DIRECTORY = os.path.join(STORES_DIRECTORY, "moodlestore")
+# Holds the name of the store version that is currently served
+CURRENT_STORE_FILE = os.path.join(STORES_DIRECTORY, "CURRENT")
+# Every process holds a shared lock on this file in a version directory while it has the version open
+STORE_PIN_FILE = ".open"
+# Held by the process updating the stores, the server's scheduled job and the reindex tool take turns
+STORE_UPDATE_LOCK_FILE = os.path.join(STORES_DIRECTORY, "update.lock")
+# "bluegreen" builds every update into a new store version and swaps it in, "inplace" updates the served store
+VECTORSTORE_UPDATE_MODE = os.getenv("VECTORSTORE_UPDATE_MODE", "bluegreen")
+# Number of previous store versions kept besides the current one
+VECTORSTORE_KEEP_VERSIONS = int(os.getenv("VECTORSTORE_KEEP_VERSIONS", "1"))
+# A new store version is rejected if it holds less than this share of the current version's documents
+VECTORSTORE_MIN_DOC_RATIO = float(os.getenv("VECTORSTORE_MIN_DOC_RATIO", "0.5"))
+# Queries that must return results from a new store version, separated by "|"
+VECTORSTORE_VALIDATION_QUERIES = [
+    query
+    for query in os.getenv("VECTORSTORE_VALIDATION_QUERIES", "Welche Kurse gibt es?").split("|")
+    if query
+]
+# Chroma rejects very large upserts, so documents are written in batches
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "256"))
+# Number of processes used to embed documents during indexing, 1 embeds in the current process
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "1"))
+# Torch threads per embedding worker, 0 keeps the torch default
+EMBEDDING_THREADS_PER_WORKER = int(os.getenv("EMBEDDING_THREADS_PER_WORKER", "0"))
+# Keep a BM25 lexical index next to every vectorstore for hybrid retrieval
+LEXICAL_INDEX_ENABLED = os.getenv("LEXICAL_INDEX_ENABLED", "true").lower() == "true"
+# "torch" runs the full precision model, "int8" a dynamically quantized copy,
+# "onnx" and "onnx-int8" an onnx export of the model through onnxruntime
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
 
-def load_vectorstore(embedding):
-    persist_directory = "data\stores\moodlestore"
-    if not os.path.exists(persist_directory):
-        os.makedirs(persist_directory)
-        # Scrape Moodle data
-        print("Scraping Moodle data")
-        site = scrape_moodle_data()
-        print("Moodle data scraped")
-
-        # Load Moodle data into documents
-        documents = []
-        documents.append(site)
-        for course in site.courses:
-            documents.append(course)
-            for section in course.sections:
-                documents.append(section)
-                for module in section.modules:
-                    documents.append(module)
-                    for content in module.contents:
-                        documents.append(content)
-
-        documents = [
-            Document(
-                page_content=str(doc),
-                metadata=doc.asdict(),
-            )
-            for doc in documents
-        ]
-
-        print("Embedding documents")
-        # Load documents into Vecorstore
-        db = Chroma.from_documents(
-            documents=documents,
-            embedding=embedding,
-            collection_metadata={"hnsw:space": "cosine"},
-            persist_directory=persist_directory,
+EMBEDDING_MODEL_NAME = "hkunlp/instructor-large"
+QUERY_INSTRUCTION = "Represent the user query for retriving relevant documents: "
+EMBED_INSTRUCTION = "Represent the document for retrieval: "
+
+
+def load_embedding_function(
+    backend: str = EMBEDDING_BACKEND, cache: bool = True, batching: bool = True
+):
+    model_name = EMBEDDING_MODEL_NAME
+    query_instruction = QUERY_INSTRUCTION
+    embed_instruction = EMBED_INSTRUCTION
+
+    if backend in ("onnx", "onnx-int8"):
+        embedding = OnnxInstructorEmbeddings(
+            model_name=model_name,
+            query_instruction=query_instruction,
+            embed_instruction=embed_instruction,
+            quantize=backend == "onnx-int8",
         )
+    elif backend in ("torch", "int8"):
+        embedding = HuggingFaceInstructEmbeddings(
+            model_name=model_name,
+            query_instruction=query_instruction,
+            embed_instruction=embed_instruction,
+        )
+        if backend == "int8":
+            embedding = quantize_torch_embeddings(embedding)
+    else:
+        raise ValueError(f"Unknown embedding backend: {backend}")
 
-        print("Vectorstore loaded")
+    # Cache hits are answered before a query is queued for batching
+    if batching and QUERY_BATCH_MAX_WAIT_MS > 0:
+        embedding = MicroBatchingEmbeddings(embedding)
+    if cache and QUERY_EMBEDDING_CACHE_SIZE > 0:
+        embedding = CachedQueryEmbeddings(embedding)
+    return embedding
 
-        print(str(len(db.get()["metadatas"])) + " documents loaded")
 
-        return db
+def batched(iterable, batch_size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, batch_size)):
+        yield batch
+
+
+_document_cache = None
+
+
+def get_document_embedding_cache():
+    # Shared by all store versions, so blue/green and full rebuilds only embed new texts
+    global _document_cache
+    if _document_cache is None and DOCUMENT_EMBEDDING_CACHE_PATH:
+        _document_cache = DocumentEmbeddingCache(
+            f"{EMBEDDING_MODEL_NAME}\n{EMBEDDING_BACKEND}\n{EMBED_INSTRUCTION}"
+        )
+    return _document_cache
+
+
+_worker_embedding = None
+
+
+def _init_embedding_worker(threads):
+    global _worker_embedding
+    if threads:
+        import torch
+
+        torch.set_num_threads(threads)
+    _worker_embedding = load_embedding_function()
+
+
+def _embed_texts(texts):
+    return _worker_embedding.embed_documents(texts)
+
+
+def embed_documents(
+    db,
+    documents: Iterable[Document],
+    batch_size: int = INDEX_BATCH_SIZE,
+    workers: int = EMBEDDING_WORKERS,
+):
+    """
+    Embed documents in batches and upsert every batch into the collection as soon as it is done.
+
+    With more than one worker the batches are embedded by a process pool, each worker
+    loading its own copy of the embedding model. At most two batches per worker are in
+    flight, so documents can be consumed lazily from a generator. Texts found in the
+    document embedding cache are not embedded again.
+    """
+    start = time.time()
+    total = 0
+    cache = get_document_embedding_cache()
+
+    def lookup(batch):
+        # Returns the cached embeddings of the batch, None for the texts that must be embedded
+        if cache is None:
+            return [None] * len(batch)
+        return cache.get_many([doc.page_content for doc in batch])
+
+    def missing_texts(batch, embeddings):
+        return [doc.page_content for doc, embedding in zip(batch, embeddings) if embedding is None]
+
+    def complete(batch, embeddings, new_embeddings):
+        if cache is not None and new_embeddings:
+            cache.put_many(missing_texts(batch, embeddings), new_embeddings)
+        new_embeddings = iter(new_embeddings)
+        write(batch, [embedding if embedding is not None else next(new_embeddings) for embedding in embeddings])
+
+    def write(batch, embeddings):
+        nonlocal total
+        with timed_pipeline("write_batch"):
+            write_batch(batch, embeddings)
+        total += len(batch)
+        elapsed = time.time() - start
+        print(
+            f"Embedded {total} documents in {elapsed:.1f}s "
+            f"({total / max(elapsed, 1e-9):.1f} docs/sec)"
+        )
+
+    def write_batch(batch, embeddings):
+        db._collection.upsert(
+            ids=[doc.metadata["doc_id"] for doc in batch],
+            embeddings=embeddings,
+            metadatas=[doc.metadata for doc in batch],
+            documents=[doc.page_content for doc in batch],
+        )
+        partitions = getattr(db, "partitions", None)
+        if partitions is not None:
+            partitions.upsert(
+                [doc.metadata["doc_id"] for doc in batch],
+                embeddings,
+                [doc.metadata for doc in batch],
+                [doc.page_content for doc in batch],
+            )
+        lexical_index = getattr(db, "lexical_index", None)
+        if lexical_index is not None:
+            lexical_index.upsert(batch)
+
+    if workers <= 1:
+        for batch in batched(documents, batch_size):
+            embeddings = lookup(batch)
+            texts = missing_texts(batch, embeddings)
+            new_embeddings = []
+            if texts:
+                with timed_pipeline("embed_batch"):
+                    new_embeddings = db.embeddings.embed_documents(texts)
+            complete(batch, embeddings, new_embeddings)
+        return total
+
+    # Spawn instead of fork, forking a process that already initialized torch can deadlock
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_embedding_worker,
+        initargs=(EMBEDDING_THREADS_PER_WORKER,),
+    ) as executor:
+        pending = {}
+        for batch in batched(documents, batch_size):
+            embeddings = lookup(batch)
+            texts = missing_texts(batch, embeddings)
+            if not texts:
+                complete(batch, embeddings, [])
+                continue
+            if len(pending) >= workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    complete(*pending.pop(future), future.result())
+            future = executor.submit(_embed_texts, texts)
+            pending[future] = (batch, embeddings)
+        for future in list(pending):
+            complete(*pending.pop(future), future.result())
+
+    return total
+
+
+def content_hash(page_content, metadata):
+    payload = json.dumps(
+        {"page_content": page_content, "metadata": metadata}, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def to_document(doc) -> Document:
+    # Chroma only accepts str, int, float and bool metadata values
+    metadata = {key: value for key, value in doc.asdict().items() if value is not None}
+    page_content = str(doc)
+    metadata["doc_id"] = doc.doc_id()
+    metadata["content_hash"] = content_hash(page_content, metadata)
+    return Document(page_content=page_content, metadata=metadata)
+
+
+def to_chunk_documents(content: MoodleModuleContent) -> List[Document]:
+    # File contents are split into chunks the embedding model can read in full,
+    # every chunk points to the module it belongs to.
+    text = str(content.text)
+    if looks_like_html(text):
+        text = html_to_text(text)
+    chunks = split_text(text)
+    documents = []
+    for index, chunk in enumerate(chunks):
+        metadata = {key: value for key, value in content.asdict().items() if value is not None}
+        metadata["doc_id"] = f"{content.doc_id()}-chunk-{index}"
+        metadata["parent_id"] = f"module-{content.module_id}"
+        metadata["chunk_index"] = index
+        metadata["chunk_count"] = len(chunks)
+        page_content = f"Filename: {content.filename}, Content: {chunk}"
+        metadata["content_hash"] = content_hash(page_content, metadata)
+        documents.append(Document(page_content=page_content, metadata=metadata))
+    return documents
+
+
+def to_documents(doc) -> List[Document]:
+    if CHUNKING_ENABLED and isinstance(doc, MoodleModuleContent) and doc.text:
+        return to_chunk_documents(doc)
+    return [to_document(doc)]
+
+
+def iter_documents(objects) -> Iterable[Document]:
+    # Deduplicate by id, Moodle may list the same file twice in a module
+    seen = set()
+    for obj in objects:
+        doc_id = obj.doc_id()
+        if doc_id in seen:
+            continue
+        seen.add(doc_id)
+        yield from to_documents(obj)
+
+
+def get_documents(site: MoodleSiteInfo) -> List[Document]:
+    # Load Moodle data into documents
+    objects = [site]
+    for course in site.courses:
+        objects.extend(iter_course_objects(course))
+    return list(iter_documents(objects))
+
+
+def sync_vectorstore(db, documents: Iterable[Document]):
+    """
+    Upsert new or changed documents and delete documents that no longer exist.
+
+    Documents are consumed lazily, only their ids are kept until the sync is done.
+    """
+    existing = db.get(include=["metadatas"])
+    existing_metadata = {
+        id: metadata or {} for id, metadata in zip(existing["ids"], existing["metadatas"])
+    }
+    partitions = getattr(db, "partitions", None)
+
+    current_ids = set()
+    unchanged = 0
+    # Documents whose course changed must leave their previous partition
+    moved = []
+
+    def changed_documents():
+        nonlocal unchanged
+        for doc in documents:
+            doc_id = doc.metadata["doc_id"]
+            current_ids.add(doc_id)
+            previous = existing_metadata.get(doc_id)
+            if previous and previous.get("content_hash") == doc.metadata["content_hash"]:
+                unchanged += 1
+                continue
+            if previous and previous.get("course_id") != doc.metadata.get("course_id"):
+                moved.append(doc_id)
+            yield doc
+
+    changed = embed_documents(db, changed_documents())
+    removed = [id for id in existing_metadata if id not in current_ids]
+
+    if removed:
+        for i in range(0, len(removed), INDEX_BATCH_SIZE):
+            db.delete(ids=removed[i : i + INDEX_BATCH_SIZE])
+        lexical_index = getattr(db, "lexical_index", None)
+        if lexical_index is not None:
+            lexical_index.delete(removed)
+    if partitions is not None and (removed or moved):
+        # Partitions only ever hold a document in the partitions named by its metadata,
+        # moved documents were already written to their new partition
+        stale = removed + moved
+        partitions.delete(stale, [existing_metadata[id] for id in stale])
+        if moved:
+            current = db.get(ids=moved, include=["embeddings", "metadatas", "documents"])
+            partitions.upsert(current["ids"], current["embeddings"], current["metadatas"], current["documents"])
+
+    print(
+        f"Synced vectorstore: {changed} changed, {len(removed)} removed, "
+        f"{unchanged} unchanged"
+    )
+
+    return changed, len(removed)
+
+
+def update_vectorstore(db, snapshot=None):
+    # Crawl Moodle course by course and embed the documents as they arrive,
+    # or read the objects of a previous crawl back from a snapshot
+    if snapshot:
+        print("Reading crawl snapshot " + snapshot + " and embedding documents")
+        objects = read_snapshot(snapshot)
     else:
-        return Chroma(
-            client=PersistentClient(persist_directory),
-            embedding_function=embedding,
-            client_settings=Settings(anonymized_telemetry=False),
-            collection_metadata={"hnsw:space": "cosine"},
+        print("Scraping Moodle data and embedding documents")
+        objects = stream_moodle_data()
+        if CRAWL_SNAPSHOT_ENABLED:
+            objects = write_snapshot(objects)
+    with timed_pipeline("update"):
+        sync_vectorstore(db, iter_documents(objects))
+    print("Vectorstore updated")
+
+    print(str(db._collection.count()) + " documents loaded")
+
+    return db
+
+
+def get_current_store_directory():
+    if os.path.exists(CURRENT_STORE_FILE):
+        with open(CURRENT_STORE_FILE, "r", encoding="utf-8") as f:
+            return os.path.join(STORES_DIRECTORY, f.read().strip())
+    return PERSIST_DIRECTORY
+
+
+def set_current_store_directory(persist_directory):
+    # Replacing the pointer file is atomic, a crash never leaves it half written
+    tmp_path = CURRENT_STORE_FILE + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(os.path.basename(persist_directory))
+    os.replace(tmp_path, CURRENT_STORE_FILE)
+
+
+# Number of open stores per persist directory in this process, other processes are seen through the pin file
+_open_stores = Counter()
+# Reentrant, since a store may be garbage collected while the lock is held
+_open_stores_lock = threading.RLock()
+
+
+def _pin_store(persist_directory):
+    # The lock is released when the file is closed or the process exits, so a crashed server never pins a version
+    if fcntl is None:
+        return None
+    pin = open(os.path.join(persist_directory, STORE_PIN_FILE), "a")
+    fcntl.flock(pin, fcntl.LOCK_SH)
+    return pin
+
+
+def _release_store(client, lexical_index, pin):
+    if lexical_index is not None:
+        lexical_index.close()
+    if pin is not None:
+        pin.close()
+    identifier = client._identifier
+    with _open_stores_lock:
+        _open_stores[identifier] -= 1
+        if _open_stores[identifier] > 0:
+            return
+        del _open_stores[identifier]
+        # chromadb caches the system of every persist directory for the lifetime of the process,
+        # so the segments and sqlite handles of a replaced version are only freed by stopping it
+        system = SharedSystemClient._identifier_to_system.pop(identifier, None)
+    if system is not None:
+        system.stop()
+
+
+def is_store_open(persist_directory) -> bool:
+    with _open_stores_lock:
+        identifiers = list(_open_stores)
+    return any(os.path.abspath(identifier) == os.path.abspath(persist_directory) for identifier in identifiers)
+
+
+def remove_store_version(persist_directory) -> bool:
+    """Remove a store version unless a store of it is open, in this or any other process."""
+    if is_store_open(persist_directory):
+        return False
+    if fcntl is None:
+        shutil.rmtree(persist_directory, ignore_errors=True)
+        return True
+    with open(os.path.join(persist_directory, STORE_PIN_FILE), "a") as pin:
+        try:
+            fcntl.flock(pin, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        # The exclusive lock is held while removing, so no process can pin the version meanwhile
+        shutil.rmtree(persist_directory, ignore_errors=True)
+    return True
+
+
+def close_vectorstore(db):
+    # Stores are otherwise released when they are garbage collected, after the last request using them
+    db._release()
+
+
+def open_vectorstore(embedding, persist_directory, client=None):
+    client = client or PersistentClient(persist_directory)
+    db = Chroma(
+        client=client,
+        embedding_function=embedding,
+        client_settings=Settings(anonymized_telemetry=False),
+        collection_metadata={"hnsw:space": "cosine"},
+    )
+    # The lexical index lives in the store directory, so store versions are copied and swapped together
+    db.lexical_index = (
+        LexicalIndex(os.path.join(persist_directory, "lexical.sqlite3"))
+        if LEXICAL_INDEX_ENABLED
+        else None
+    )
+    db.partitions = (
+        VectorStorePartitions(db._client, embedding, db.lexical_index)
+        if PARTITIONS_ENABLED
+        else None
+    )
+    with _open_stores_lock:
+        _open_stores[client._identifier] += 1
+    # The finalizer must not reference the store itself, otherwise it would never be collected
+    db._release = weakref.finalize(db, _release_store, client, db.lexical_index, _pin_store(persist_directory))
+    return db
+
+
+def build_partitions(db):
+    # Stores created before partitions were introduced are partitioned from their stored vectors
+    total = db._collection.count()
+    print(f"Building partitions for {total} documents")
+    for offset in range(0, total, INDEX_BATCH_SIZE):
+        stored = db.get(
+            limit=INDEX_BATCH_SIZE, offset=offset, include=["embeddings", "documents", "metadatas"]
+        )
+        db.partitions.upsert(
+            stored["ids"],
+            stored["embeddings"],
+            [metadata or {} for metadata in stored["metadatas"]],
+            stored["documents"],
+        )
+
+
+def build_lexical_index(db):
+    # Stores created before the lexical index was introduced are indexed from their stored documents
+    total = db._collection.count()
+    print(f"Building lexical index for {total} documents")
+    for offset in range(0, total, INDEX_BATCH_SIZE):
+        stored = db.get(limit=INDEX_BATCH_SIZE, offset=offset, include=["documents", "metadatas"])
+        db.lexical_index.upsert(
+            Document(page_content=page_content, metadata={**(metadata or {}), "doc_id": id})
+            for id, page_content, metadata in zip(stored["ids"], stored["documents"], stored["metadatas"])
         )
+
+
+def open_store_client():
+    # Opening the client does not need the embedding model, so it can run while the model loads
+    persist_directory = get_current_store_directory()
+    is_new = not os.path.exists(persist_directory)
+    if is_new:
+        os.makedirs(persist_directory)
+    return persist_directory, PersistentClient(persist_directory), is_new
+
+
+def load_vectorstore(embedding, store=None):
+    persist_directory, client, is_new = store or open_store_client()
+
+    db = open_vectorstore(embedding, persist_directory, client)
+
+    with store_update_lock():
+        if is_new:
+            update_vectorstore(db)
+        else:
+            if db.lexical_index is not None and db.lexical_index.count() == 0:
+                build_lexical_index(db)
+            if db.partitions is not None and not db.partitions.exists(SITE_PARTITION):
+                build_partitions(db)
+
+    return db
+
+
+def validate_vectorstore(db, previous_count):
+    count = db._collection.count()
+    if count == 0:
+        print("Validation failed: vectorstore is empty")
+        return False
+    if count < previous_count * VECTORSTORE_MIN_DOC_RATIO:
+        print(f"Validation failed: {count} documents, previously {previous_count}")
+        return False
+    for query in VECTORSTORE_VALIDATION_QUERIES:
+        if not db.similarity_search(query, k=1):
+            print(f"Validation failed: no results for query '{query}'")
+            return False
+    return True
+
+
+_store_update_lock = threading.Lock()
+
+
+@contextmanager
+def store_update_lock():
+    with _store_update_lock:
+        if fcntl is None:
+            yield
+            return
+        os.makedirs(STORES_DIRECTORY, exist_ok=True)
+        # Closing the file releases the lock
+        with open(STORE_UPDATE_LOCK_FILE, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                print("Waiting for another vectorstore update to finish")
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+
+def remove_old_store_versions(current_directory, keep=VECTORSTORE_KEEP_VERSIONS, previous_directory=None):
+    # Versions are named by creation time, so sorting by name sorts by age
+    prefix = os.path.basename(PERSIST_DIRECTORY)
+    versions = sorted(
+        name
+        for name in os.listdir(STORES_DIRECTORY)
+        if name.startswith(prefix)
+        and os.path.isdir(os.path.join(STORES_DIRECTORY, name))
+        and os.path.join(STORES_DIRECTORY, name) != current_directory
+    )
+    # The previous versions may still serve requests that started before the swap
+    for name in versions[: max(len(versions) - keep, 0)]:
+        # The version served before the swap may be served by a process that has not reloaded yet
+        if previous_directory and os.path.abspath(os.path.join(STORES_DIRECTORY, name)) == os.path.abspath(
+            previous_directory
+        ):
+            continue
+        if remove_store_version(os.path.join(STORES_DIRECTORY, name)):
+            print("Removed old vectorstore version " + name)
+        else:
+            # Removed by a later update, once no process uses it anymore
+            print("Keeping old vectorstore version " + name + ", it is still open")
+
+
+def refresh_vectorstore(db, embedding, snapshot=None, rebuild=False):
+    """
+    Update the vectorstore and return the store that should be served afterwards.
+
+    In bluegreen mode the current store is copied into a new version directory, synced
+    with Moodle (or with a crawl snapshot) and validated. The new version is only returned
+    if it passes validation, otherwise the current store keeps being served. Old versions
+    are removed afterwards. With `rebuild` the new version starts empty, so every document
+    is embedded again, e.g. after changing the embedding model.
+    """
+    # Updates of the server and the reindex tool would otherwise copy and swap versions concurrently
+    with store_update_lock():
+        return _refresh_vectorstore(db, embedding, snapshot, rebuild)
+
+
+def _refresh_vectorstore(db, embedding, snapshot, rebuild):
+    if VECTORSTORE_UPDATE_MODE == "inplace" and not rebuild:
+        return update_vectorstore(db, snapshot)
+
+    current_directory = get_current_store_directory()
+    version_directory = f"{PERSIST_DIRECTORY}-{time.strftime('%Y%m%d%H%M%S')}"
+    print("Building vectorstore version " + os.path.basename(version_directory))
+    if rebuild:
+        os.makedirs(version_directory)
+    else:
+        # Writers hold the update lock, so the current version is not modified while it is copied
+        shutil.copytree(current_directory, version_directory)
+
+    new_db = None
+    try:
+        new_db = open_vectorstore(embedding, version_directory)
+        update_vectorstore(new_db, snapshot)
+        with timed_pipeline("validate"):
+            valid = validate_vectorstore(new_db, db._collection.count())
+    except Exception:
+        if new_db is not None:
+            close_vectorstore(new_db)
+        shutil.rmtree(version_directory, ignore_errors=True)
+        raise
+
+    if not valid:
+        close_vectorstore(new_db)
+        shutil.rmtree(version_directory, ignore_errors=True)
+        return db
+
+    set_current_store_directory(version_directory)
+    remove_old_store_versions(version_directory, previous_directory=current_directory)
+    return new_db
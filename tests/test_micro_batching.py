@@ -0,0 +1,70 @@
+from langchain_core.embeddings import Embeddings
+from src.models.embeddings import MicroBatchingEmbeddings
+from typing import List
+import threading
+import asyncio
+
+
+class BlockingEmbeddings(Embeddings):
+    """Embeds texts by their length, each batch waits until `release` is set."""
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.batches = []
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.batches.append(list(texts))
+        self.started.set()
+        self.release.wait(5)
+        return [[float(len(text))] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def test_cancelled_query_does_not_stop_the_worker():
+    inner = BlockingEmbeddings()
+    embeddings = MicroBatchingEmbeddings(inner, max_wait_ms=0)
+
+    async def run():
+        first = asyncio.create_task(embeddings.aembed_query("first"))
+        # The worker is busy with the first batch, so the second query waits in the queue
+        await asyncio.get_running_loop().run_in_executor(None, inner.started.wait, 5)
+        second = asyncio.create_task(embeddings.aembed_query("second"))
+        await asyncio.sleep(0)
+        _, queued = embeddings._queue.queue[0]
+        second.cancel()
+        # The cancel reaches the queued future through a callback of the event loop
+        while not queued.cancelled():
+            await asyncio.sleep(0)
+        inner.release.set()
+        assert await asyncio.wait_for(first, 5) == [5.0]
+        try:
+            await second
+        except asyncio.CancelledError:
+            pass
+        return await asyncio.wait_for(embeddings.aembed_query("third"), 5)
+
+    assert asyncio.run(run()) == [5.0]
+    assert embeddings._worker.is_alive()
+    # The cancelled query is dropped instead of being embedded
+    assert ["second"] not in inner.batches
+
+
+def test_failed_batch_is_reported_and_the_worker_keeps_running():
+    class FailingOnce(BlockingEmbeddings):
+        def embed_documents(self, texts):
+            if not self.batches:
+                self.batches.append(list(texts))
+                raise RuntimeError("model failed")
+            return [[float(len(text))] for text in texts]
+
+    embeddings = MicroBatchingEmbeddings(FailingOnce(), max_wait_ms=0)
+    try:
+        embeddings.embed_query("first")
+    except RuntimeError as e:
+        assert str(e) == "model failed"
+    else:
+        raise AssertionError("the error of the batch was not raised")
+    assert embeddings.embed_query("second") == [6.0]